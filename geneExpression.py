@@ -6,7 +6,8 @@ The modules we are going to use are as followed:
 """
 
 # After installing the below modules, dont forget to restart the runtime, as it needs to change the modules which the versions are changed.
-!pip install --quiet numpy==1.23.0 pydeseq2 gseapy dash-bio
+# (in a notebook, run the install as its own cell; as a script or module this file installs nothing)
+# !pip install --quiet numpy==1.23.0 pydeseq2 gseapy dash-bio
 
 # This error is not a problem for our tasks:
 # ERROR: pip's dependency resolver does not currently take into account all the packages that are installed.
@@ -18,40 +19,44 @@ The modules we are going to use are as followed:
 
 import pandas as pd
 import numpy as np
+import io
+import sys
 import copy
+import os
+import functools
+import argparse
+import json
+import time
+import shutil
+import hashlib
+import resource
+import base64
+import tempfile
+import re
+import threading
+import tracemalloc
+import cProfile
+import platform
+import sqlite3
+import urllib.parse
+import urllib.request
+from contextlib import closing, contextmanager, redirect_stdout
+from importlib import metadata
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 np.seterr(all="ignore")
 
-# DGE and Pathway Enrichment
-from pydeseq2.dds import DeseqDataSet
-from pydeseq2.ds import DeseqStats
-import gseapy as gp
-from gseapy import Biomart
-
-# PCA
-from sklearn.decomposition import PCA
-
-# Viz.
-import plotly.express as px
-import dash_bio
-from gseapy import dotplot
+# DGE and Pathway Enrichment (pydeseq2, gseapy), PCA (sklearn), Viz. (plotly, matplotlib, dash_bio) and scipy
+# take seconds to import, so they are imported inside the functions that use them
 
 """The following are helper functions for visualizations that are in DESeq2 but not in PyDESeq2 such as: Run PCA/plot, Volcano Plot, Dispersion Plot, MA Plot.
 
 Run the following cell as we are going to need these functions in the downstream analysis.
 """
 
-def plotPCA(dds, clinical_df, nTop=0, vst=True, returnData=False):
-
-  if vst:
-    counts = dds.layers['vst_counts']
-  else:
-    counts = dds.layers['normed_counts']
-
-  colwise_var = np.var(counts, axis=0)
-  idx = np.argpartition(colwise_var, -nTop)[-nTop:] if nTop > 0 else (-colwise_var).argsort()[:]
-
-  pca = PCA(n_components=3)
-  pca_data = pca.fit_transform(counts[:, idx])
+def plotPCA(dds, clinical_df, nTop=0, vst=True, returnData=False, solver='full', batch_size=None, name='pca'):
+  import plotly.express as px
+  pca, pca_data = pca_stage(dds, nTop=nTop, vst=vst, solver=solver, batch_size=batch_size)[:2]
   print(f'Explained Variance Ratio :{sum(pca.explained_variance_ratio_)}')
 
   index_to_use = dds.obsm['design_matrix'].index
@@ -64,12 +69,13 @@ def plotPCA(dds, clinical_df, nTop=0, vst=True, returnData=False):
 
   fig = px.scatter_3d(pca_df, x='pc1', y='pc2', z='pc3',
                     color='organ', symbol='condition')
-  fig.show()
+  show_figure(fig, name)
 
   if returnData:
     return pca, pca_data
 
-def plotVolcano(stat_res, lfc_thr=[-1, 1], padj_thr=0.05):
+def plotVolcano(stat_res, lfc_thr=[-1, 1], padj_thr=0.05, name='volcano'):
+  import dash_bio
   res_df = stat_res.results_df
 
   plot_df = res_df.dropna()
@@ -86,271 +92,1999 @@ def plotVolcano(stat_res, lfc_thr=[-1, 1], padj_thr=0.05):
       ylabel='-log10(Adjusted p-value)',
       xlabel='Effect Size: log2(fold-change)')
 
-  fig.show()
+  show_figure(fig, name)
 
-def plotDispEsts(dds):
-  gene_est = list(np.log(dds.varm['genewise_dispersions']))
-  fit = list(np.log(dds.varm['fitted_dispersions']))
-  final = list(np.log(dds.varm['dispersions']))
-  n = len(gene_est)
+def plotDispEsts(dds=None, max_points=None, render_mode='auto', name='dispersion', res_df=None):
+  import plotly.express as px
+  plot_df = dispersion_plot_data(dds, res_df=res_df)
+  if max_points:
+    plot_df = downsample_plot_data(plot_df, 'mean_norm_counts', 'dispersion', max_points)
 
-  m_norm_counts = list(np.log(np.average(dds.layers['normed_counts'], axis=0)))
+  fig = px.scatter(plot_df, y = 'dispersion', x = 'mean_norm_counts', color = 'name', opacity=0.8, render_mode=render_mode)
+  show_figure(fig, name)
 
-  plot_df = pd.DataFrame({
-      'dispersion': gene_est + fit + final,
-      'name': ['Genewise Dispersions'] * n + ['Fitted Dispersions'] * n + ['Final Dispersions'] * n,
-      'mean_norm_counts': m_norm_counts * 3
-  })
+def plotMA(stat_res, padj_thr=0.05, max_points=None, render_mode='auto', name='ma'):
+  import plotly.express as px
+  plot_df = ma_plot_data(stat_res, padj_thr)
+  if max_points:
+    plot_df = downsample_plot_data(plot_df, 'log10 (Mean of Normalized Counts Per Gene)', 'log2 Fold-Change', max_points)
 
-  fig = px.scatter(plot_df, y = 'dispersion', x = 'mean_norm_counts', color = 'name', opacity=0.8)
-  fig.show()
+  fig = px.scatter(plot_df, y = 'log2 Fold-Change', x = 'log10 (Mean of Normalized Counts Per Gene)', color = 'padj Significance', render_mode=render_mode)
+  show_figure(fig, name)
 
-def plotMA(stat_res, padj_thr=0.05):
-  dds = stat_res.dds
-  res_df = stat_res.results_df
+"""The plot functions show their figures with show_figure(). Inside a collect_figures() block the figures are collected as (name, figure) pairs instead of being shown, which is how run_pipeline() renders them without a notebook.
+"""
 
-  colors = ['sig' if float(padj) <= padj_thr else 'non-sig' for padj in list(res_df['padj'])]
-  l2fc =list(res_df['log2FoldChange'])
+_figure_sink = None
 
-  m_norm_counts = np.log10(np.average(dds.layers['normed_counts'], axis=0))
+def show_figure(fig, name):
+  if _figure_sink is None:
+    fig.show()
+  else:
+    _figure_sink.append((name, fig))
+
+@contextmanager
+def collect_figures():
+  global _figure_sink
+  previous, _figure_sink = _figure_sink, []
+  try:
+    yield _figure_sink
+  finally:
+    _figure_sink = previous
+
+"""plotPCA gets its components from pca_stage(). The top-nTop variance genes and the fitted PCA are cached in dds.uns['pca_cache'], keyed by the layer, nTop, solver, batch size and number of components, and are reused as long as the count layer is the same array with the same contents (checked with a hash of the whole layer, which is cheap next to the fit). plotPCA(returnData=True) still returns (pca, pca_data), and the gene loadings of the cached fit are attached to it as pca.loadings_. solver='randomized' uses a randomized SVD, and solver='incremental' fits an IncrementalPCA over batches of samples so memory stays bounded by batch_size rows of the nTop genes. project_samples() places new samples onto the cached components without refitting; they must already be transformed like the dds layer, as nothing here applies the existing VST fit to new samples (run dds.vst() on a dataset that includes them instead). cached_vst() keeps dds.vst() output on disk keyed by a hash of the counts, so the transform is not recomputed every session.
+"""
 
-  plot_df = pd.DataFrame({
-      'padj Significance': colors,
-      'log2 Fold-Change': l2fc,
-      'log10 (Mean of Normalized Counts Per Gene)': m_norm_counts
-  })
+PCAResult = namedtuple('PCAResult', ['pca', 'pca_data', 'loadings', 'idx'])
+
+def _sample_batches(n, batch_size, min_size):
+  # row slices of batch_size; a short last batch is merged into the previous
+  # one because IncrementalPCA needs at least n_components rows per batch
+  starts = list(range(0, n, batch_size))
+  if len(starts) > 1 and n - starts[-1] < min_size:
+    starts.pop()
+  return [slice(start, stop) for start, stop in zip(starts, starts[1:] + [n])]
+
+def _column_var(counts, batches):
+  # per-gene variance over the samples, accumulated over row batches
+  total = np.zeros(counts.shape[1])
+  total_sq = np.zeros(counts.shape[1])
+  for rows in batches:
+    batch = np.asarray(counts[rows], dtype=float)
+    total += batch.sum(axis=0)
+    total_sq += np.square(batch).sum(axis=0)
+  mean = total / counts.shape[0]
+  return np.maximum(total_sq / counts.shape[0] - mean ** 2, 0)
+
+def pca_stage(dds, nTop=0, vst=True, solver='full', batch_size=None, n_components=3):
+  from sklearn.decomposition import PCA, IncrementalPCA
+  layer = 'vst_counts' if vst else 'normed_counts'
+  counts = dds.layers[layer]
+  key = (layer, nTop, solver, batch_size, n_components)
+  digest = _layer_digest(counts)
+  cache = dds.uns.setdefault('pca_cache', {})
+  cached = cache.get(key)
+  if cached is not None and cached['source'] is counts and cached['digest'] == digest:
+    return cached['result']
+
+  if solver == 'incremental':
+    if batch_size is not None and batch_size < n_components:
+      raise ValueError(f'batch_size={batch_size} is smaller than n_components={n_components}; '
+                       'IncrementalPCA needs at least n_components samples per batch')
+    batches = _sample_batches(counts.shape[0], batch_size or 256, n_components)
+    colwise_var = _column_var(counts, batches)
+  else:
+    colwise_var = np.var(counts, axis=0)
+  # nTop at or above the number of genes keeps them all, like nTop=0
+  idx = np.argpartition(colwise_var, -nTop)[-nTop:] if 0 < nTop < len(colwise_var) else (-colwise_var).argsort()[:]
+
+  if solver == 'incremental':
+    pca = IncrementalPCA(n_components=n_components)
+    for rows in batches:
+      pca.partial_fit(np.asarray(counts[rows])[:, idx])
+    pca_data = np.concatenate([pca.transform(np.asarray(counts[rows])[:, idx]) for rows in batches])
+  else:
+    pca = PCA(n_components=n_components, svd_solver='randomized' if solver == 'randomized' else 'auto')
+    pca_data = pca.fit_transform(counts[:, idx])
+
+  loadings = pd.DataFrame(pca.components_.T, index=dds.var_names[idx],
+                          columns=[f'pc{i + 1}' for i in range(n_components)])
+  pca.loadings_ = loadings
+  result = PCAResult(pca=pca, pca_data=pca_data, loadings=loadings, idx=idx)
+  cache[key] = {'source': counts, 'digest': digest, 'result': result}
+  return result
+
+def project_samples(dds, new_counts, nTop=0, vst=True, solver='full', batch_size=None, n_components=3):
+  # new_counts: samples x genes, transformed the same way as the dds layer
+  result = pca_stage(dds, nTop=nTop, vst=vst, solver=solver, batch_size=batch_size, n_components=n_components)
+  return result.pca.transform(new_counts[result.loadings.index].to_numpy())
+
+def _array_digest(*parts):
+  h = hashlib.blake2b(digest_size=16)
+  for part in parts:
+    if isinstance(part, np.ndarray):
+      h.update(str((part.dtype, part.shape)).encode())
+      h.update(np.ascontiguousarray(part).data)
+    else:
+      h.update(repr(part).encode())
+  return h.hexdigest()
+
+def _layer_digest(layer):
+  return _array_digest(np.asarray(layer))
+
+def cached_vst(dds, cache_dir='vst_cache', **vst_kwargs):
+  key = _array_digest(np.asarray(dds.X), list(dds.obs_names), list(dds.var_names), sorted(vst_kwargs.items()))
+  npy_path = os.path.join(cache_dir, f'{key}.npy')
+  if os.path.exists(npy_path):
+    try:
+      vst_counts = np.load(npy_path)
+      if vst_counts.shape == dds.shape:
+        dds.layers['vst_counts'] = vst_counts
+        return dds
+    except (OSError, ValueError):
+      pass
+
+  dds.vst(**vst_kwargs)
+  os.makedirs(cache_dir, exist_ok=True)
+  tmp_npy = npy_path + '.tmp.npy'
+  np.save(tmp_npy, np.asarray(dds.layers['vst_counts']))
+  os.replace(tmp_npy, npy_path)
+  return dds
+
+"""The plot functions above take their data frames from the helpers below. They are built with NumPy arrays and categorical columns instead of Python lists, and the per-gene mean of the normalized counts is computed once and kept in dds.uns together with the layer it came from, so plotting the same dds again does not average the whole count layer again; it is recomputed once the normed_counts layer is replaced (e.g. by deseq2()), but not after edits made in place to the same array. For very large gene sets, pass max_points to keep every point in sparse regions and thin out only the dense ones. render_mode='webgl' draws the points with scattergl; plotly's default 'auto' already switches to it above 1000 points.
+"""
 
-  fig = px.scatter(plot_df, y = 'log2 Fold-Change', x = 'log10 (Mean of Normalized Counts Per Gene)', color = 'padj Significance')
-  fig.show()
+DISPERSION_KEYS = ['genewise_dispersions', 'fitted_dispersions', 'dispersions']
+
+DISPERSION_NAMES = ['Genewise Dispersions', 'Fitted Dispersions', 'Final Dispersions']
+
+def mean_normed_counts(dds):
+  # keyed on the layer object only: hashing the layer would cost about as much as the mean
+  counts = dds.layers['normed_counts']
+  cached = dds.uns.get('mean_normed_counts')
+  if cached is None or cached['source'] is not counts:
+    cached = dds.uns['mean_normed_counts'] = {'source': counts, 'mean': np.asarray(counts.mean(axis=0)).ravel()}
+  return cached['mean']
+
+def dispersion_plot_data(dds=None, res_df=None):
+  # res_df: a per-gene table from run_contrasts() instead of a dds, which carries
+  # the dispersion columns and baseMean (the mean of the normalized counts)
+  if (dds is None) == (res_df is None):
+    raise TypeError('dispersion_plot_data() takes either a dds or a res_df')
+  if res_df is not None:
+    n = len(res_df)
+    m_norm_counts = np.log(res_df['baseMean'].to_numpy(dtype=float))
+    dispersions = [res_df[key].to_numpy(dtype=float) for key in DISPERSION_KEYS]
+  else:
+    n = dds.n_vars
+    m_norm_counts = np.log(mean_normed_counts(dds))
+    dispersions = [dds.varm[key] for key in DISPERSION_KEYS]
+
+  return pd.DataFrame({
+      'dispersion': np.log(np.concatenate(dispersions)),
+      'name': pd.Categorical.from_codes(np.repeat(np.arange(3), n), categories=DISPERSION_NAMES),
+      'mean_norm_counts': np.tile(m_norm_counts, 3)
+  })
 
-"""Download the dge-data.zip file from SUCourse and extract. You will find two text files. Upload them on this colab notebook. Run the below cell.
+def ma_plot_data(stat_res, padj_thr=0.05):
+  res_df = stat_res.results_df
+  padj = res_df['padj'].to_numpy(dtype=float)
+  if stat_res.dds is None:
+    m_norm_counts = res_df['baseMean'].to_numpy(dtype=float)
+  else:
+    m_norm_counts = mean_normed_counts(stat_res.dds)
+
+  return pd.DataFrame({
+      # NaN padj compares False, so those genes stay non-sig as before
+      'padj Significance': pd.Categorical.from_codes((padj <= padj_thr).astype(np.int8), categories=['non-sig', 'sig']),
+      'log2 Fold-Change': res_df['log2FoldChange'].to_numpy(dtype=float),
+      'log10 (Mean of Normalized Counts Per Gene)': np.log10(m_norm_counts)
+  }, index=res_df.index)
+
+def downsample_plot_data(plot_df, x, y, max_points, bins=None, seed=0):
+  if len(plot_df) <= max_points:
+    return plot_df
+
+  # bin the points on a bins x bins grid and keep at most `cap` random points
+  # per cell, with the largest cap that stays within max_points; the default
+  # grid has at most max_points / 4 cells so every cell can keep some points
+  bins = bins or max(int(np.sqrt(max_points) / 2), 1)
+  xy = plot_df[[x, y]].to_numpy(dtype=float)
+  finite = np.isfinite(xy).all(axis=1)
+  lo, hi = xy[finite].min(axis=0), xy[finite].max(axis=0)
+  cell = np.floor((xy - lo) / np.where(hi > lo, hi - lo, 1) * (bins - 1)).clip(0, bins - 1)
+  cell = np.where(finite, cell[:, 0] * bins + cell[:, 1], -1).astype(np.int64)
+
+  rng = np.random.default_rng(seed)
+  order = rng.permutation(len(cell))
+  order = order[np.argsort(cell[order], kind='stable')]
+  starts = np.flatnonzero(np.r_[True, np.diff(cell[order]) != 0])
+  sizes = np.diff(np.r_[starts, len(cell)])
+  rank = np.empty(len(cell), dtype=np.int64)
+  rank[order] = np.arange(len(cell)) - np.repeat(starts, sizes)
+
+  # points kept with cap = sizes[i]: every smaller cell in full plus sizes[i] from each larger one
+  sizes = np.sort(sizes)
+  larger = np.arange(len(sizes) - 1, -1, -1)
+  kept = np.cumsum(sizes) + sizes * larger
+  i = np.searchsorted(kept, max_points, side='right') - 1
+  cap = 1 if i < 0 else sizes[i] + (max_points - kept[i]) // max(larger[i], 1)
+  return plot_df[rank < max(cap, 1)]
+
+"""The following helper streams counts.tsv in row chunks instead of reading the whole text table, transposing it and filtering it afterwards. Genes are rows in counts.tsv, so the low-count filter can be applied chunk by chunk, and only the genes that pass are written into a preallocated integer buffer (uint32 when the counts fit). The result is the same sample-by-gene counts_df as before, holding roughly one copy of the filtered matrix at its peak.
+"""
 
-**Task 1**: Print the two dataframes that you have imported. What do you see, describe both of the dataframes.
+def _count_lines(path, block_size=1 << 20):
+  n = 0
+  last = b'\n'
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      n += block.count(b'\n')
+      last = block[-1:]
+  # the last line counts too when the file does not end with a newline
+  return n + (last != b'\n')
+
+def _peak_rss_mb():
+  # ru_maxrss is reported in kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _check_counts(values, path):
+  if len(values) and values.min() < 0:
+    raise ValueError(f'Negative counts in {path}')
+
+def _count_reader(path, samples, index_col, chunksize):
+  header = pd.read_csv(path, sep='\t', nrows=0).columns
+  missing = [s for s in samples if s not in header]
+  if missing:
+    raise KeyError(f'Samples missing from {path}: {missing}')
+  return pd.read_csv(path, sep='\t', usecols=[index_col] + samples,
+                     dtype={index_col: str, **{s: np.int64 for s in samples}},
+                     chunksize=chunksize)
+
+def load_counts(path, clinical_df, min_count=10, chunksize=10000, index_col='geneIDs', verbose=True):
+  samples = list(clinical_df.index)
+
+  # gene-major buffer, so each chunk is a contiguous block of rows and the
+  # unused tail can be released in place once the kept gene count is known
+  capacity = max(_count_lines(path) - 1, 0)
+  buf = np.empty((capacity, len(samples)), dtype=np.uint32)
+  genes = []
+  n_rows = 0
+  n_kept = 0
+
+  start = time.perf_counter()
+  for chunk in _count_reader(path, samples, index_col, chunksize):
+    values = chunk[samples].to_numpy()
+    _check_counts(values, path)
+    keep = values.sum(axis=1) >= min_count
+    values = values[keep]
+    k = len(values)
+    if k:
+      wide = values.max() > np.iinfo(buf.dtype).max
+      if wide or n_kept + k > len(buf):
+        # only the rows filled so far are copied into the new buffer
+        grown = np.empty((max(len(buf), n_kept + k), len(samples)), dtype=np.uint64 if wide else buf.dtype)
+        grown[:n_kept] = buf[:n_kept]
+        buf = grown
+      buf[n_kept:n_kept + k] = values
+      genes.extend(chunk[index_col].to_numpy()[keep])
+    n_kept += k
+    n_rows += len(chunk)
+  elapsed = time.perf_counter() - start
+
+  buf.resize((n_kept, len(samples)), refcheck=False)
+  counts_df = pd.DataFrame(buf.T, index=pd.Index(samples, name=clinical_df.index.name),
+                           columns=pd.Index(genes, name=index_col), copy=False)
+
+  report = {
+      'rows': n_rows,
+      'genes_kept': n_kept,
+      'samples': len(samples),
+      'dtype': str(buf.dtype),
+      'seconds': elapsed,
+      'rows_per_sec': n_rows / elapsed if elapsed > 0 else float('inf'),
+      'peak_rss_mb': _peak_rss_mb(),
+  }
+  counts_df.attrs['load_report'] = report
+  if verbose:
+    print(f"Loaded {report['rows']} genes x {report['samples']} samples, kept {report['genes_kept']} "
+          f"({report['dtype']}) at {report['rows_per_sec']:.0f} rows/sec, peak RSS {report['peak_rss_mb']:.1f} MB")
+
+  return counts_df
+
+"""load_counts_cached() keeps the filtered matrix from load_counts() as a .npy file next to a JSON manifest holding the sample and gene index. The files are named after a hash of the source paths, so different datasets (even ones whose files share a name) never share a cache file, while a rewritten counts.tsv reuses its old cache files instead of leaving them behind. The manifest holds a content hash of the source TSVs, the sample list and min_count. On later runs the matrix is memory-mapped straight from disk and no text is parsed. A cache that is stale (source or threshold changed) or unreadable (truncated file, broken manifest, wrong shape) is rebuilt automatically.
 """
 
-clinical_df = pd.read_csv('clinical.tsv', sep='\t')
-clinical_df = clinical_df.set_index('sampleID')
-clinical_df = clinical_df.sort_index(ascending=True)
+def _file_digest(path, block_size=1 << 20):
+  h = hashlib.blake2b(digest_size=16)
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      h.update(block)
+  return h.hexdigest()
+
+def _cache_key(path, clinical_df, clinical_path, min_count):
+  h = hashlib.blake2b(digest_size=16)
+  h.update(_file_digest(path).encode())
+  if clinical_path is not None:
+    h.update(_file_digest(clinical_path).encode())
+  h.update(json.dumps([list(map(str, clinical_df.index)), min_count]).encode())
+  return h.hexdigest()
+
+def _source_key(path, clinical_path):
+  h = hashlib.blake2b(digest_size=8)
+  h.update(json.dumps([os.path.abspath(path), clinical_path and os.path.abspath(clinical_path)]).encode())
+  return h.hexdigest()
+
+def _read_counts_cache(npy_path, manifest_path, key):
+  with open(manifest_path) as f:
+    manifest = json.load(f)
+  if manifest['key'] != key:
+    raise ValueError('stale cache')
+  if os.path.getsize(npy_path) != manifest['npy_bytes']:
+    raise ValueError('cache file size does not match manifest')
+
+  values = np.load(npy_path, mmap_mode='r')
+  shape = (len(manifest['samples']), len(manifest['genes']))
+  if values.shape != shape or str(values.dtype) != manifest['dtype']:
+    raise ValueError('cache array does not match manifest')
+
+  counts_df = pd.DataFrame(values,
+                           index=pd.Index(manifest['samples'], name=manifest['index_names'][0]),
+                           columns=pd.Index(manifest['genes'], name=manifest['index_names'][1]),
+                           copy=False)
+  counts_df.attrs['load_report'] = manifest['load_report']
+  counts_df.attrs['cache_key'] = key
+  return counts_df
+
+def _write_counts_cache(counts_df, npy_path, manifest_path, key):
+  # write both files under temporary names first so an interrupted run never
+  # leaves a manifest pointing at a half-written array
+  tmp_npy = npy_path + '.tmp.npy'
+  np.save(tmp_npy, counts_df.to_numpy())
+  os.replace(tmp_npy, npy_path)
+
+  manifest = {
+      'key': key,
+      'dtype': str(counts_df.to_numpy().dtype),
+      'npy_bytes': os.path.getsize(npy_path),
+      'index_names': [counts_df.index.name, counts_df.columns.name],
+      'samples': list(map(str, counts_df.index)),
+      'genes': list(map(str, counts_df.columns)),
+      'load_report': counts_df.attrs.get('load_report', {}),
+  }
+  tmp_manifest = manifest_path + '.tmp'
+  with open(tmp_manifest, 'w') as f:
+    json.dump(manifest, f)
+  os.replace(tmp_manifest, manifest_path)
+
+def load_counts_cached(path, clinical_df, clinical_path=None, min_count=10, cache_dir='counts_cache', verbose=True, **kwargs):
+  os.makedirs(cache_dir, exist_ok=True)
+  name = os.path.splitext(os.path.basename(path))[0]
+  key = _cache_key(path, clinical_df, clinical_path, min_count)
+  source = _source_key(path, clinical_path)
+  npy_path = os.path.join(cache_dir, f'{name}-{source}.npy')
+  manifest_path = os.path.join(cache_dir, f'{name}-{source}.manifest.json')
+
+  if os.path.exists(manifest_path):
+    start = time.perf_counter()
+    try:
+      counts_df = _read_counts_cache(npy_path, manifest_path, key)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+      if verbose:
+        print(f'Rebuilding counts cache for {path}: {e}')
+    else:
+      if verbose:
+        print(f'Memory-mapped {counts_df.shape[0]} samples x {counts_df.shape[1]} genes '
+              f'from {npy_path} in {time.perf_counter() - start:.2f}s')
+      return counts_df
+
+  counts_df = load_counts(path, clinical_df, min_count=min_count, verbose=verbose, **kwargs)
+  _write_counts_cache(counts_df, npy_path, manifest_path, key)
+  counts_df.attrs['cache_key'] = key
+  return counts_df
+
+"""For mostly-zero tables (single-cell-like or low-depth data) load_counts_sparse() reads the same counts.tsv into a SparseCounts: a scipy.sparse CSC matrix of uint32 counts (samples x genes) with its sample and gene index. Each chunk is filtered for low counts as it is read, and only its non-zero entries are kept. sparse_size_factors() gives the same median-of-ratios size factors as DeseqDataSet.fit_size_factors(), and densifies only the genes without zeros, which are the only genes the ratios use. sparse_normed_counts() divides the stored entries by them and stays sparse. densify_counts() builds the usual dense counts_df only for the samples and genes a DeseqDataSet actually needs, e.g. one organ refiltered for low counts. bench_sparse_memory() compares the memory of this path with the dense one at several sparsity levels.
+"""
 
-counts_df = pd.read_csv('counts.tsv', sep='\t')
-counts_df = counts_df.set_index('geneIDs')
-counts_df = counts_df.T.loc[clinical_df.index]
-counts_df = counts_df.sort_index(ascending=True)
+SparseCounts = namedtuple('SparseCounts', ['matrix', 'samples', 'genes', 'report'])
+
+def _sparse_nbytes(matrix):
+  return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+def load_counts_sparse(path, clinical_df, min_count=10, chunksize=10000, index_col='geneIDs', verbose=True):
+  from scipy import sparse
+  samples = list(clinical_df.index)
+  blocks = []
+  genes = []
+  n_rows = 0
+
+  start = time.perf_counter()
+  for chunk in _count_reader(path, samples, index_col, chunksize):
+    values = chunk[samples].to_numpy()
+    _check_counts(values, path)
+    keep = values.sum(axis=1) >= min_count
+    if keep.any():
+      values = values[keep]
+      dtype = np.uint32 if values.max() <= np.iinfo(np.uint32).max else np.uint64
+      blocks.append(sparse.csr_matrix(values.astype(dtype)))
+      genes.extend(chunk[index_col].to_numpy()[keep])
+    n_rows += len(chunk)
+  elapsed = time.perf_counter() - start
+
+  # genes x samples CSR transposes to samples x genes CSC without a copy
+  by_gene = sparse.vstack(blocks, format='csr') if blocks else sparse.csr_matrix((0, len(samples)), dtype=np.uint32)
+  matrix = by_gene.T.tocsc()
+  report = {
+      'rows': n_rows,
+      'genes_kept': matrix.shape[1],
+      'samples': len(samples),
+      'dtype': str(matrix.dtype),
+      'density': matrix.nnz / max(matrix.shape[0] * matrix.shape[1], 1),
+      'mb': _sparse_nbytes(matrix) / 2**20,
+      'seconds': elapsed,
+      'rows_per_sec': n_rows / elapsed if elapsed > 0 else float('inf'),
+      'peak_rss_mb': _peak_rss_mb(),
+  }
+  if verbose:
+    print(f"Loaded {report['rows']} genes x {report['samples']} samples, kept {report['genes_kept']} "
+          f"({report['dtype']}, {report['density']:.1%} non-zero, {report['mb']:.1f} MB) "
+          f"at {report['rows_per_sec']:.0f} rows/sec, peak RSS {report['peak_rss_mb']:.1f} MB")
+
+  return SparseCounts(matrix=matrix, samples=pd.Index(samples, name=clinical_df.index.name),
+                      genes=pd.Index(genes, name=index_col), report=report)
+
+def sparse_size_factors(counts):
+  matrix = counts.matrix.tocsc()
+  # a gene with a zero count has an infinite log mean and is left out of the ratios,
+  # so only the genes counted in every sample are densified
+  full = np.flatnonzero(np.diff(matrix.indptr) == matrix.shape[0])
+  if not len(full):
+    raise ValueError('Every gene contains at least one zero, so median-of-ratios size factors are undefined; '
+                     "fit them on densify_counts() output with fit_size_factors(fit_type='iterative')")
+  log_counts = np.log(matrix[:, full].toarray())
+  return np.exp(np.median(log_counts - log_counts.mean(0), axis=1))
+
+def sparse_normed_counts(counts, size_factors=None, dtype=np.float64):
+  from scipy import sparse
+  size_factors = sparse_size_factors(counts) if size_factors is None else np.asarray(size_factors)
+  return (sparse.diags(1 / size_factors) @ counts.matrix.astype(dtype)).tocsc()
+
+def densify_counts(counts, samples=None, genes=None, min_count=None):
+  samples = counts.samples if samples is None else pd.Index(samples, name=counts.samples.name)
+  genes = counts.genes if genes is None else pd.Index(genes, name=counts.genes.name)
+  rows = counts.samples.get_indexer(samples)
+  cols = counts.genes.get_indexer(genes)
+  if (rows < 0).any() or (cols < 0).any():
+    raise KeyError(f'Unknown samples {list(samples[rows < 0])} or genes {list(genes[cols < 0])}')
+
+  matrix = counts.matrix[:, cols][rows]
+  if min_count is not None:
+    keep = np.asarray(matrix.sum(axis=0)).ravel() >= min_count
+    matrix, genes = matrix[:, keep], genes[keep]
+  return pd.DataFrame(matrix.toarray(), index=samples, columns=genes)
+
+def bench_sparse_memory(sparsities=(0.5, 0.8, 0.9, 0.95, 0.99), n_genes=30000, n_samples=200, min_count=10,
+                        n_housekeeping=500, seed=0):
+  from scipy import sparse
+  from pydeseq2.preprocessing import deseq2_norm
+  rng = np.random.default_rng(seed)
+  base_mean = rng.lognormal(mean=2.0, sigma=1.5, size=n_genes)
+  rows = []
+  for sparsity in sparsities:
+    values = rng.negative_binomial(2, 2 / (2 + base_mean), size=(n_samples, n_genes))
+    dropout = rng.random(values.shape) < sparsity
+    # housekeeping genes are counted in every sample, so the median-of-ratios factors stay defined
+    dropout[:, :n_housekeeping] = False
+    values[:, :n_housekeeping] += 1
+    values[dropout] = 0
+
+    # the loaded representations: an int64 frame as read_csv returns it, and the uint32 CSC matrix
+    counts_df = pd.DataFrame(values)
+    matrix = sparse.csc_matrix(values.astype(np.uint32))
+    del values
+
+    tracemalloc.start()
+    filtered_df = counts_df.loc[:, counts_df.sum() >= min_count]
+    dense_normed, dense_factors = deseq2_norm(filtered_df.to_numpy())
+    dense_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    dense_mb = (counts_df.memory_usage(index=False).sum() + dense_peak) / 2**20
+    del filtered_df, dense_normed
+
+    tracemalloc.start()
+    keep = np.asarray(matrix.sum(axis=0)).ravel() >= min_count
+    counts = SparseCounts(matrix=matrix[:, keep], samples=pd.RangeIndex(n_samples),
+                          genes=pd.RangeIndex(n_genes)[keep], report={})
+    sparse_factors = sparse_size_factors(counts)
+    sparse_normed = sparse_normed_counts(counts, sparse_factors)
+    sparse_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    sparse_mb = (_sparse_nbytes(matrix) + sparse_peak) / 2**20
+    if not np.allclose(sparse_factors, dense_factors):
+      raise RuntimeError(f'Sparse size factors differ from deseq2_norm at sparsity {sparsity}')
+
+    rows.append({'sparsity': sparsity, 'density': matrix.nnz / (n_samples * n_genes),
+                 'genes_kept': int(keep.sum()), 'dense_mb': dense_mb, 'sparse_mb': sparse_mb,
+                 'saved_mb': dense_mb - sparse_mb, 'saved': 1 - sparse_mb / dense_mb})
+    del counts_df, matrix, counts, sparse_normed
+
+  report = pd.DataFrame(rows)
+  print(report.to_string(index=False, float_format='{:.2f}'.format))
+  return report
+
+"""run_contrasts() runs the same treated-vs-reference DESeq2 contrast (DeseqDataSet -> deseq2() -> DeseqStats.summary() -> lfc_shrink) for every group in the metadata, e.g. every organ, in a pool of worker processes. The sample subsets are derived from clinical_df instead of hard-coded sample IDs. Workers do not receive a pickled copy of the count matrix: they memory-map the same .npy file (the load_counts_cached() file when counts_df comes from it, otherwise a temporary one) and only read the rows of their own subset. Each job carries the cache key, shape and dtype of the matrix it was submitted with, and the worker refuses a file that no longer matches; a cache file that already changed at submission is replaced by a temporary copy. bench_contrast_scaling() times the same contrasts with different numbers of workers. Several studies can be submitted to the same pool with run_studies(). Both return one tidy table with a row per study, group and gene.
+"""
 
-# PRINT CLINICAL DF
+def _memmap_path(counts_df):
+  values = counts_df.to_numpy()
+  while values is not None and not isinstance(values, np.memmap):
+    values = values.base
+  if isinstance(values, np.memmap) and values.filename and values.shape == counts_df.shape:
+    return values.filename
+  return None
+
+def _manifest_key(npy_path):
+  manifest_path = os.path.splitext(npy_path)[0] + '.manifest.json'
+  if not os.path.exists(manifest_path):
+    return None
+  with open(manifest_path) as f:
+    return json.load(f).get('key')
+
+def _shared_counts(counts_df):
+  # the file counts_df was mapped from, but only while it still holds this exact matrix
+  npy_path = _memmap_path(counts_df)
+  if npy_path is None:
+    return None
+  try:
+    values = np.load(npy_path, mmap_mode='r')
+    key = _manifest_key(npy_path)
+  except (OSError, ValueError):
+    return None
+  if values.shape != counts_df.shape or values.dtype != counts_df.to_numpy().dtype:
+    return None
+  if key != counts_df.attrs.get('cache_key', key):
+    return None
+  return npy_path, key
+
+def contrast_subsets(clinical_df, group_col='organ', factor='condition', tested='cis', ref='untrt'):
+  subsets = {}
+  for group, group_df in clinical_df.groupby(group_col, sort=True):
+    levels = set(group_df[factor])
+    if tested not in levels or ref not in levels:
+      print(f'Skipping {group_col}={group}: needs both {factor}={tested} and {factor}={ref}')
+      continue
+    subsets[group] = list(group_df.index)
+  return subsets
+
+def _deseq_contrast(npy_path, expected, sample_pos, genes, metadata, factor, tested, ref, n_cpus):
+  from pydeseq2.dds import DeseqDataSet
+  from pydeseq2.ds import DeseqStats
+  # copies only this subset's rows out of the shared memory-mapped matrix,
+  # after checking that the file still holds the matrix the job was submitted with
+  key, shape, dtype = expected
+  values = np.load(npy_path, mmap_mode='r')
+  if values.shape != shape or str(values.dtype) != dtype or (key is not None and _manifest_key(npy_path) != key):
+    raise ValueError(f'{npy_path} no longer holds the {shape} {dtype} counts this contrast was submitted with')
+  counts = pd.DataFrame(np.asarray(values[sample_pos]), index=metadata.index, columns=genes)
+
+  dds = DeseqDataSet(
+      counts=counts,
+      metadata=metadata,
+      design_factors=factor,
+      refit_cooks=True,
+      ref_level=[factor, ref],
+      n_cpus=n_cpus,
+  )
+  dds.deseq2()
+
+  stat_res = DeseqStats(dds, contrast=[factor, tested, ref], n_cpus=n_cpus)
+  stat_res.summary()
+  lfc_unshrunken = stat_res.results_df['log2FoldChange'].to_numpy(copy=True)
+  stat_res.lfc_shrink(coeff=f'{factor}_{tested}_vs_{ref}')
+
+  res_df = stat_res.results_df.copy()
+  res_df['log2FoldChange_unshrunken'] = lfc_unshrunken
+  for key in DISPERSION_KEYS:
+    res_df[key] = dds.varm[key]
+  return res_df
+
+def run_studies(studies, group_col='organ', factor='condition', tested='cis', ref='untrt', max_workers=None, n_cpus=1):
+  max_workers = max_workers or os.cpu_count()
+  tmp_dir = tempfile.mkdtemp(prefix='deseq_counts_')
+  try:
+    jobs = []
+    for study_index, (study, (counts_df, clinical_df)) in enumerate(studies.items()):
+      shared = _shared_counts(counts_df)
+      if shared is None:
+        npy_path, key = os.path.join(tmp_dir, f'{study_index}.npy'), None
+        np.save(npy_path, counts_df.to_numpy())
+      else:
+        npy_path, key = shared
+      expected = (key, counts_df.shape, str(counts_df.to_numpy().dtype))
+      genes = counts_df.columns
+      sample_pos = pd.Series(np.arange(len(counts_df)), index=counts_df.index)
+      for group, samples in contrast_subsets(clinical_df, group_col, factor, tested, ref).items():
+        jobs.append((study, group, genes.name or 'geneIDs', (npy_path, expected, sample_pos[samples].to_numpy(), genes,
+                                    clinical_df.loc[samples], factor, tested, ref, n_cpus)))
+
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+      futures = {pool.submit(_deseq_contrast, *args): (study, group, gene_col)
+                 for study, group, gene_col, args in jobs}
+      for future in as_completed(futures):
+        study, group, gene_col = futures[future]
+        res_df = future.result()
+        res_df = res_df.rename_axis(gene_col).reset_index()
+        res_df.insert(0, 'contrast', f'{factor}_{tested}_vs_{ref}')
+        res_df.insert(0, group_col, group)
+        res_df.insert(0, 'study', study)
+        results.append(res_df)
+  finally:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+  if not results:
+    return pd.DataFrame()
+  return pd.concat(results, ignore_index=True).sort_values(['study', group_col], kind='stable', ignore_index=True)
+
+def run_contrasts(counts_df, clinical_df, study='study', **kwargs):
+  return run_studies({study: (counts_df, clinical_df)}, **kwargs)
+
+def bench_contrast_scaling(worker_counts=(1, 2, 4), n_groups=4, n_genes=5000, replicates=3, seed=0):
+  data_dir = tempfile.mkdtemp(prefix='contrast_scaling_')
+  try:
+    counts_path, clinical_path = os.path.join(data_dir, 'counts.tsv'), os.path.join(data_dir, 'clinical.tsv')
+    simulate_counts(counts_path, clinical_path, n_genes=n_genes, replicates=replicates,
+                    organs=tuple(f'organ{i}' for i in range(n_groups)), seed=seed)
+    clinical_df = pd.read_csv(clinical_path, sep='\t').set_index('sampleID')
+    # the second call maps the cache written by the first, as in a later session
+    for _ in range(2):
+      counts_df = load_counts_cached(counts_path, clinical_df, clinical_path=clinical_path,
+                                     cache_dir=os.path.join(data_dir, 'cache'), verbose=False)
+    rows = []
+    for workers in worker_counts:
+      start = time.perf_counter()
+      with redirect_stdout(io.StringIO()):
+        run_contrasts(counts_df, clinical_df, max_workers=workers)
+      rows.append({'workers': workers, 'seconds': time.perf_counter() - start})
+  finally:
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+  report = pd.DataFrame(rows)
+  report['speedup'] = report['seconds'].iloc[0] / report['seconds']
+  report['efficiency'] = report['speedup'] / (report['workers'] / report['workers'].iloc[0])
+  print(f'{n_groups} groups x {replicates * 2} samples x {n_genes} genes on {os.cpu_count()} CPUs')
+  print(report.to_string(index=False, float_format='{:.2f}'.format))
+  return report
+
+"""To keep the unshrunken LFCs for the MA plot we only need the results columns, not a deep copy of the whole DeseqStats object (which would also copy the embedded dds with its count layers, design matrix and dispersions). snapshot_stats() copies just those columns and keeps a reference to the same dds, so it can be passed to plotMA, plotVolcano and filter_degs wherever a live stat_res is accepted.
+"""
 
-print(clinical_df)
+StatsSnapshot = namedtuple('StatsSnapshot', ['dds', 'results_df'])
 
-# PRINT COUNTS DF
+SNAPSHOT_COLUMNS = ['baseMean', 'log2FoldChange', 'lfcSE', 'pvalue', 'padj']
 
-print(counts_df)
+def snapshot_stats(stat_res, columns=SNAPSHOT_COLUMNS):
+  # lfc_shrink overwrites results_df columns in place, so they must be copied
+  return StatsSnapshot(dds=stat_res.dds, results_df=stat_res.results_df[columns].copy())
 
+def filter_degs(stat_res, padj_thr=0.05, lfc_thr=1):
+  res_df = stat_res.results_df
+  res_df = res_df[res_df['padj'] <= padj_thr]
+  up_degs_df = res_df[res_df['log2FoldChange'] >= lfc_thr]
+  down_degs_df = res_df[res_df['log2FoldChange'] <= -lfc_thr]
+  return up_degs_df, down_degs_df
+
+def bench_snapshot_memory(n_genes=30000, n_samples=4, seed=0):
+  from pydeseq2.dds import DeseqDataSet
+  from pydeseq2.ds import DeseqStats
+  rng = np.random.default_rng(seed)
+  samples = [f'S{i}' for i in range(n_samples)]
+  counts = pd.DataFrame(rng.negative_binomial(5, 0.01, size=(n_samples, n_genes)),
+                        index=samples, columns=[f'G{i}' for i in range(n_genes)])
+  metadata = pd.DataFrame({'condition': ['untrt', 'cis'] * (n_samples // 2)}, index=samples)
+
+  bench_dds = DeseqDataSet(counts=counts, metadata=metadata, design_factors='condition',
+                           refit_cooks=True, ref_level=['condition', 'untrt'])
+  bench_dds.deseq2()
+  bench_stat_res = DeseqStats(bench_dds, contrast=['condition', 'cis', 'untrt'])
+  bench_stat_res.summary()
+
+  peaks = {}
+  for name, fn in [('deepcopy', copy.deepcopy), ('snapshot', snapshot_stats)]:
+    tracemalloc.start()
+    kept = fn(bench_stat_res)
+    peaks[name] = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    del kept
+
+  print(f"{n_genes} genes x {n_samples} samples: deepcopy {peaks['deepcopy']:.1f} MB, "
+        f"snapshot {peaks['snapshot']:.1f} MB ({peaks['deepcopy'] / peaks['snapshot']:.0f}x less)")
+  return peaks
+
+"""The following helpers run the over-representation analysis locally instead of sending every gene list to the Enrichr service. Gene set libraries (GMT files, or the dicts returned by gp.get_library) are loaded once into a sparse gene x term matrix. enrichr_local() then scores many gene lists in one pass: the overlaps of all lists with all terms come from a single sparse matrix product, and hypergeometric p-values with Benjamini-Hochberg adjustment are computed on the non-zero overlaps only. The results use the same columns as gp.enrichr, so the 'Adjusted P-value' filters and dotplot(enr.res2d, ...) work unchanged. As in the gseapy offline mode, the background is every gene found in the loaded libraries unless one is given, either as a number of genes or as a list of genes, in which case both the gene lists and the terms are restricted to it. Odds ratios use the Haldane +0.5 correction, so they (and the combined scores) stay finite when a term is fully covered.
+"""
 
+GeneSetIndex = namedtuple('GeneSetIndex', ['genes', 'terms', 'libraries', 'matrix'])
+
+EnrichrResult = namedtuple('EnrichrResult', ['results', 'res2d'])
+
+ENRICHR_COLUMNS = ['Gene_set', 'Term', 'Overlap', 'P-value', 'Adjusted P-value', 'Odds Ratio', 'Combined Score', 'Genes']
+
+def read_gmt(path):
+  gene_sets = {}
+  with open(path) as f:
+    for line in f:
+      fields = line.rstrip('\n').split('\t')
+      if len(fields) > 2:
+        # Enrichr GMT files may carry ",weight" after each gene
+        gene_sets[fields[0]] = [g.split(',')[0] for g in fields[2:] if g]
+  return gene_sets
+
+def load_gene_sets(libraries):
+  from scipy import sparse
+  terms, term_libraries, term_genes = [], [], []
+  for library, gene_sets in libraries.items():
+    if isinstance(gene_sets, str):
+      gene_sets = read_gmt(gene_sets)
+    for term, genes in gene_sets.items():
+      terms.append(term)
+      term_libraries.append(library)
+      term_genes.append(list(dict.fromkeys(str(g).upper() for g in genes)))
+
+  sizes = np.array([len(g) for g in term_genes])
+  genes, gene_idx = np.unique(np.concatenate(term_genes) if term_genes else np.array([], dtype=str), return_inverse=True)
+  matrix = sparse.csr_matrix((np.ones(len(gene_idx), dtype=np.int32), (gene_idx, np.repeat(np.arange(len(terms)), sizes))),
+                             shape=(len(genes), len(terms)))
+  return GeneSetIndex(genes=pd.Index(genes), terms=np.array(terms, dtype=object),
+                      libraries=np.array(term_libraries, dtype=object), matrix=matrix)
+
+def _pmf_tail(log_pmf, x, N, K, n, up, steps=8):
+  # sum of pmf(x), pmf(x+1), ... (or pmf(x), pmf(x-1), ...) using the pmf ratio
+  # recurrence. The ratio hits exactly 0 at the end of the support and the terms
+  # only shrink in that direction, so entries are dropped once their terms stop
+  # changing the total; the arrays are only compacted every few steps
+  out = np.zeros(len(x))
+  pos = np.arange(len(x))
+  x = x.astype(float)
+  K, n = K.astype(float), n.astype(float)
+  term = np.exp(log_pmf)
+  total = term.copy()
+  while pos.size:
+    for _ in range(steps):
+      if up:
+        term *= (K - x) * (n - x) / ((x + 1) * (N - K - n + x + 1))
+        x += 1
+      else:
+        term *= x * (N - K - n + x) / ((K - x + 1) * (n - x + 1))
+        x -= 1
+      total += term
+    more = term > 1e-16 * total
+    out[pos[~more]] = total[~more]
+    pos, x, K, n, term, total = (a[more] for a in (pos, x, K, n, term, total))
+  return out
+
+def _hypergeom_sf(k, N, K, n):
+  from scipy import special
+  # P(X >= k). Above the mean the upper tail is summed directly; below it the
+  # lower tail is shorter, and 1 - P(X <= k - 1) loses no precision there
+  logfact = special.gammaln(np.arange(N + 2))
+  def log_pmf(x, K, n):
+    lchoose = lambda a, b: logfact[a + 1] - logfact[b + 1] - logfact[a - b + 1]
+    return lchoose(K, x) + lchoose(N - K, n - x) - lchoose(N, n)
+
+  pvals = np.ones(len(k))
+  up = k * N >= n * K
+  pvals[up] = _pmf_tail(log_pmf(k[up], K[up], n[up]), k[up], N, K[up], n[up], up=True)
+
+  down = ~up & (k - 1 >= np.maximum(0, n + K - N))
+  km, Kd, nd = k[down] - 1, K[down], n[down]
+  pvals[down] = 1 - _pmf_tail(log_pmf(km, Kd, nd), km, N, Kd, nd, up=False)
+  return np.clip(pvals, 0, 1)
+
+def _bh_adjust(pvals, bounds):
+  # Benjamini-Hochberg within each pvals[bounds[i]:bounds[i + 1]], each already sorted
+  padj = np.empty_like(pvals)
+  for start, stop in zip(bounds[:-1], bounds[1:]):
+    p = pvals[start:stop]
+    q = p * len(p) / np.arange(1, len(p) + 1)
+    padj[start:stop] = np.minimum(np.minimum.accumulate(q[::-1])[::-1], 1)
+  return padj
+
+def _overlap_genes(index, gene_pos, terms):
+  # overlapping genes per term, read from the library rows of this list's genes only
+  hits = index.matrix[gene_pos].tocsc()
+  names = index.genes[gene_pos].tolist()
+  return [';'.join([names[j] for j in hits.indices[hits.indptr[t]:hits.indptr[t + 1]]]) for t in terms]
+
+def _background_mask(index, background):
+  # (number of background genes, mask of the library genes inside the background)
+  if background is None:
+    return len(index.genes), np.ones(len(index.genes), dtype=bool)
+  if isinstance(background, (int, np.integer)):
+    # every list and term gene is a library gene, so this also bounds the list and term sizes
+    if background < len(index.genes):
+      raise ValueError(f'background={background} is smaller than the {len(index.genes)} genes in the libraries')
+    return int(background), np.ones(len(index.genes), dtype=bool)
+  if isinstance(background, (str, bytes)) or not hasattr(background, '__iter__'):
+    raise TypeError(f'background must be a number of genes or a list of genes, not {type(background).__name__}')
+  genes = pd.Index(list(dict.fromkeys(str(g).upper() for g in background)))
+  return len(genes), index.genes.isin(genes)
+
+def enrichr_local(gene_lists, index, background=None, return_genes=True):
+  from scipy import sparse
+  names = list(gene_lists)
+  if not names:
+    return {}
+  n_background, in_background = _background_mask(index, background)
+  term_sizes = np.asarray(index.matrix[in_background].sum(axis=0)).ravel()
+
+  # list x gene indicator of the genes that are present in the libraries (and the background)
+  rows, cols = [], []
+  for i, name in enumerate(names):
+    pos = index.genes.get_indexer(list(dict.fromkeys(str(g).upper() for g in gene_lists[name])))
+    pos = pos[pos >= 0]
+    pos = pos[in_background[pos]]
+    rows.append(np.full(len(pos), i))
+    cols.append(pos)
+  rows, cols = np.concatenate(rows), np.concatenate(cols)
+  lists = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(names), len(index.genes)))
+  list_sizes = np.asarray(lists.sum(axis=1)).ravel()
+
+  overlap = (lists @ index.matrix).tocoo()
+  list_id, term_id, k = overlap.row, overlap.col, overlap.data.astype(np.int64)
+  K, n = term_sizes[term_id], list_sizes[list_id]
+  pvals = _hypergeom_sf(k, n_background, K, n)
+  odds_ratio = ((k + 0.5) * (n_background - K - n + k + 0.5)) / ((n - k + 0.5) * (K - k + 0.5))
+  combined = -np.log(np.maximum(pvals, np.finfo(float).tiny)) * odds_ratio
+
+  # the product comes out in list order, so only each list's rows need sorting by p-value
+  bounds = np.searchsorted(list_id, np.arange(len(names) + 1))
+  order = np.concatenate([start + np.argsort(pvals[start:stop], kind='stable')
+                          for start, stop in zip(bounds[:-1], bounds[1:])] or [np.array([], dtype=int)])
+  term_id, k, K = term_id[order], k[order], K[order]
+  pvals, odds_ratio, combined = pvals[order], odds_ratio[order], combined[order]
+  padj = _bh_adjust(pvals, bounds)
+  numbers = np.array([str(i) for i in range(K.max(initial=0) + 1)], dtype=object)
+
+  all_res_df = pd.DataFrame({
+      'Gene_set': index.libraries[term_id],
+      'Term': index.terms[term_id],
+      'Overlap': numbers[k] + '/' + numbers[K],
+      'P-value': pvals,
+      'Adjusted P-value': padj,
+      'Odds Ratio': odds_ratio,
+      'Combined Score': combined,
+  }, columns=ENRICHR_COLUMNS)
+
+  results = {}
+  for i, name in enumerate(names):
+    res_df = all_res_df.iloc[bounds[i]:bounds[i + 1]].reset_index(drop=True)
+    if return_genes:
+      res_df['Genes'] = _overlap_genes(index, lists[i].indices, term_id[bounds[i]:bounds[i + 1]])
+    results[name] = EnrichrResult(results=res_df, res2d=res_df)
+  return results
+
+def load_library(name, organism='Mouse', gmt_path=None):
+  import gseapy as gp
+  gmt_path = gmt_path or f'{name}.gmt'
+  return load_gene_sets({name: gmt_path if os.path.exists(gmt_path) else gp.get_library(name, organism=organism)})
+
+"""stage() instruments one step of the analysis. Used as a context manager (or as a decorator through instrumented()), it records the wall time, the CPU time of this process and of the worker processes that finished during the stage, the peak RSS reached inside the stage and any input sizes passed as keywords (samples, genes, DEG counts, batches, ...). For worker processes the kernel only reports the largest RSS of any finished child since the start of the session, so that is recorded as children_peak_rss_mb_lifetime rather than as a per-stage value. The record is yielded, so sizes only known at the end of the stage can be added to it. Records are appended to STAGE_LOG unless another list is given, and write_stage_log() saves them as JSON or CSV. Passing profile='cprofile' (or 'pyinstrument', when it is installed) also profiles that single stage and writes the profile next to the log.
+"""
 
-"""<< The clinical_df shows the true labels of each of the samples with the sample ids and the labels, which include the organ names and the condition (untrt = untreated and cis=cisplatin-treated). The counts_df shows the gene expression levels observed in the experiments with all of the samples for each of the different genes, which have different ids listed in the gene_ids row.>>
+STAGE_LOG = []
+_open_stages = []
+
+def _rss_status_mb(field):
+  # VmRSS / VmHWM from /proc, in megabytes; None where /proc is not available
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith(field + ':'):
+          return int(line.split()[1]) / 1024
+  except OSError:
+    return None
+
+def _reset_peak_rss():
+  # writing 5 to clear_refs resets the VmHWM high-water mark on Linux
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+    return True
+  except OSError:
+    return False
+
+@contextmanager
+def _profiled(profiler, path):
+  if profiler == 'cprofile':
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+      yield path + '.prof'
+    finally:
+      profile.disable()
+      profile.dump_stats(path + '.prof')
+  elif profiler == 'pyinstrument':
+    from pyinstrument import Profiler  # optional dependency, only needed for this profiler
+    profile = Profiler()
+    profile.start()
+    try:
+      yield path + '.html'
+    finally:
+      profile.stop()
+      with open(path + '.html', 'w') as f:
+        f.write(profile.output_html())
+  else:
+    raise ValueError(f"Unknown profiler {profiler!r}, expected 'cprofile' or 'pyinstrument'")
+
+@contextmanager
+def stage(name, log=None, profile=None, profile_dir='.', **sizes):
+  log = STAGE_LOG if log is None else log
+  record = dict.fromkeys(['stage', 'wall_seconds', 'cpu_seconds', 'children_cpu_seconds',
+                          'peak_rss_mb', 'rss_delta_mb', 'children_peak_rss_mb_lifetime'])
+  record.update(stage=name, **sizes)
+  rss_start = _rss_status_mb('VmRSS')
+  if _open_stages:
+    # the enclosing stage keeps the high-water mark reached before this one resets it
+    _open_stages[-1]['peak'] = max(_open_stages[-1]['peak'], _rss_status_mb('VmHWM') or 0)
+  per_stage_peak = _reset_peak_rss()
+  frame = {'peak': 0}
+  _open_stages.append(frame)
+  times_start = os.times()
+  cpu_start = time.process_time()
+  wall_start = time.perf_counter()
+  try:
+    if profile:
+      os.makedirs(profile_dir, exist_ok=True)
+      with _profiled(profile, os.path.join(profile_dir, name)) as profile_path:
+        record['profile'] = profile_path
+        yield record
+    else:
+      yield record
+  finally:
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    times_end = os.times()
+    _open_stages.pop()
+    peak = max(frame['peak'], _rss_status_mb('VmHWM') or 0) if per_stage_peak else _peak_rss_mb()
+    if _open_stages:
+      _open_stages[-1]['peak'] = max(_open_stages[-1]['peak'], peak)
+    rss_end = _rss_status_mb('VmRSS')
+    record.update({
+        'wall_seconds': wall,
+        'cpu_seconds': cpu,
+        'children_cpu_seconds': (times_end.children_user + times_end.children_system
+                                 - times_start.children_user - times_start.children_system),
+        'peak_rss_mb': peak,
+        'rss_delta_mb': rss_end - rss_start if rss_start is not None else None,
+        # the kernel only keeps the largest RSS of any finished child, over the whole
+        # process lifetime, so this cannot be narrowed down to the stage
+        'children_peak_rss_mb_lifetime': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    })
+    log.append(record)
+
+def instrumented(name=None, **stage_kwargs):
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with stage(name or func.__name__, **stage_kwargs):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def write_stage_log(records=None, path='stages.json'):
+  records = STAGE_LOG if records is None else records
+  if path.endswith('.csv'):
+    pd.DataFrame(records).convert_dtypes().to_csv(path, index=False)
+  else:
+    with open(path, 'w') as f:
+      json.dump(records, f, indent=2, default=str)
+  return path
 
-**Task 2**: Keep only the columns in the counts_df that the sum of the counts are bigger or equal than 10 for each gene. We want to eliminate genes which produced very low counts across all samples.
+"""map_ids() converts Ensembl gene ids to Entrez gene names with the biomart API. Mappings are kept in a local SQLite cache, so only ids that were never looked up before are sent to biomart, in concurrent batches with retries. import_id_table() can fill the cache from a downloaded biomart/Ensembl TSV export so that the mapping runs fully offline. batch_subs() is the list-in, names-out form used in Task 9, and bench_id_mapping() measures the cache hit rate and latency against a local stub biomart server, returning the map_ids() report of a cold, a half-cached and a fully cached run as a table.
 """
 
-#Filter out genes that have less than 10 counts across samples
+BIOMART_URL = 'http://www.ensembl.org/biomart/martservice'
 
-counts_df = counts_df.loc[:, counts_df.iloc[:, :].sum() >= 10]
-counts_df
+BIOMART_DATASET = 'mmusculus_gene_ensembl'
 
-"""**Task 3**: You are going to create DeseqDataSet object from your counts_df and clinical_df. DeseqDataSet object contains the methods for DESeq2 workflow and necessary transformations.
+BIOMART_QUERY = ('<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE Query>'
+                 '<Query virtualSchemaName="default" formatter="TSV" header="0" uniqueRows="1" datasetConfigVersion="0.6">'
+                 '<Dataset name="{dataset}" interface="default">'
+                 '<Filter name="ensembl_gene_id" value="{ids}"/>'
+                 '<Attribute name="ensembl_gene_id"/><Attribute name="entrezgene_accession"/>'
+                 '</Dataset></Query>')
 
-Go to this [link](https://pydeseq2.readthedocs.io/en/latest/auto_examples/plot_minimal_pydeseq2_pipeline.html#sphx-glr-auto-examples-plot-minimal-pydeseq2-pipeline-py)
+def chunks(lst, n):
+    for i in range(0, len(lst), n):
+        yield lst[i:i + n]
 
-Try to understand how to create DeseqDataSet object.
+def _id_cache(cache_path):
+  con = sqlite3.connect(cache_path)
+  con.execute('CREATE TABLE IF NOT EXISTS id_map ('
+              'dataset TEXT NOT NULL, ensembl_gene_id TEXT NOT NULL, entrezgene_accession TEXT, '
+              'PRIMARY KEY (dataset, ensembl_gene_id))')
+  return con
+
+def import_id_table(path, cache_path='id_cache.sqlite', dataset=BIOMART_DATASET,
+                    id_col='Gene stable ID', name_col='NCBI gene (formerly Entrezgene) accession'):
+  table = pd.read_csv(path, sep='\t', usecols=[id_col, name_col], dtype=str)
+  # an id without an accession is stored as NULL so it is never re-fetched
+  table = table.sort_values(name_col, na_position='last').drop_duplicates(id_col)
+  rows = [(dataset, i, n if isinstance(n, str) and n else None)
+          for i, n in zip(table[id_col], table[name_col])]
+  with closing(_id_cache(cache_path)) as con, con:
+    con.executemany('INSERT OR REPLACE INTO id_map VALUES (?, ?, ?)', rows)
+  return len(rows)
+
+def _fetch_biomart(ids, dataset, url, retries, backoff, timeout):
+  data = urllib.parse.urlencode({'query': BIOMART_QUERY.format(dataset=dataset, ids=','.join(ids))}).encode()
+  for attempt in range(retries + 1):
+    try:
+      with urllib.request.urlopen(url, data=data, timeout=timeout) as response:
+        text = response.read().decode()
+      if text.startswith('Query ERROR'):
+        raise RuntimeError(text.strip())
+      break
+    except (OSError, RuntimeError):
+      if attempt == retries:
+        raise
+      time.sleep(backoff * 2 ** attempt)
+
+  mapping = dict.fromkeys(ids)
+  for line in text.splitlines():
+    fields = line.split('\t')
+    if len(fields) == 2 and fields[1] and mapping.get(fields[0]) is None:
+      mapping[fields[0]] = fields[1]
+  return mapping
+
+def map_ids(ids, cache_path='id_cache.sqlite', dataset=BIOMART_DATASET, url=BIOMART_URL,
+            batch_size=200, max_workers=4, retries=3, backoff=1.0, timeout=60, offline=False, verbose=True,
+            stats=None):
+  start = time.perf_counter()
+  ids = list(dict.fromkeys(map(str, ids)))
+  mapping = {}
+
+  with closing(_id_cache(cache_path)) as con:
+    for batch in chunks(ids, 500):
+      rows = con.execute(f'SELECT ensembl_gene_id, entrezgene_accession FROM id_map '
+                         f'WHERE dataset = ? AND ensembl_gene_id IN ({",".join("?" * len(batch))})',
+                         [dataset, *batch])
+      mapping.update(rows)
+    misses = [i for i in ids if i not in mapping]
+    hits = len(ids) - len(misses)
+    batches = 0
+
+    if misses and not offline:
+      with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_fetch_biomart, batch, dataset, url, retries, backoff, timeout)
+                   for batch in chunks(misses, batch_size)]
+        batches = len(futures)
+        for future in as_completed(futures):
+          fetched = future.result()
+          with con:
+            con.executemany('INSERT OR REPLACE INTO id_map VALUES (?, ?, ?)',
+                            [(dataset, i, n) for i, n in fetched.items()])
+          mapping.update(fetched)
+
+  report = {
+      'ids': len(ids),
+      'cache_hits': hits,
+      'hit_rate': hits / len(ids) if ids else 1.0,
+      'fetched': 0 if offline else len(misses),
+      'batches': batches,
+      'seconds': time.perf_counter() - start,
+  }
+  if stats is not None:
+    stats.update(report)
+  if verbose:
+    print(f"Mapped {report['ids']} ids: cache hit rate {report['hit_rate']:.1%}, "
+          f"{report['fetched']} fetched, {report['seconds']:.2f}s")
+
+  return {i: mapping.get(i) for i in ids}
+
+def batch_subs(degs, n=200, stats=None):
+  mapping = map_ids(degs, batch_size=n, stats=stats)
+  return [mapping[i].upper() for i in map(str, degs) if mapping[i]]
+
+def _stub_biomart(latency=0.05, failures=0):
+  import http.server
+  class Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+      body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+      query = urllib.parse.parse_qs(body)['query'][0]
+      ids = re.search(r'<Filter name="ensembl_gene_id" value="([^"]*)"', query).group(1).split(',')
+      time.sleep(latency)
+      with lock:
+        server.requests.append(ids)
+        failing = len(server.requests) <= failures
+      if failing:
+        # the first `failures` requests get a server error, to exercise the retries
+        self.send_response(503)
+        self.end_headers()
+        return
+      # every tenth id has no Entrez accession, like many non-coding genes
+      text = ''.join(f'{i}\t{"" if n % 10 == 0 else "Gene" + i[-6:]}\n' for n, i in enumerate(ids))
+      self.send_response(200)
+      self.end_headers()
+      self.wfile.write(text.encode())
+
+    def log_message(self, *args):
+      pass
+
+  lock = threading.Lock()
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+  server.requests = []
+  server.url = f'http://127.0.0.1:{server.server_address[1]}/biomart/martservice'
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+def bench_id_mapping(n_ids=5000, latency=0.05, max_workers=4):
+  server = _stub_biomart(latency)
+  url = server.url
+  ids = [f'ENSMUSG{i:011d}' for i in range(n_ids)]
+  # half the ids cold, then all of them (half cached), then all of them again (all cached)
+  runs = {'cold': ids[:n_ids // 2], 'mixed': ids, 'warm': ids}
+  mappings, rows = {}, []
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    cache_path = os.path.join(tmp_dir, 'id_cache.sqlite')
+    try:
+      for run, run_ids in runs.items():
+        stats = {}
+        mappings[run] = map_ids(run_ids, cache_path=cache_path, url=url, max_workers=max_workers,
+                                verbose=False, stats=stats)
+        rows.append({'run': run, **stats})
+    finally:
+      server.shutdown()
+  cold, mixed, warm = mappings['cold'], mappings['mixed'], mappings['warm']
+  if mixed != warm or any(mixed[i] != cold[i] for i in cold):
+    raise RuntimeError('cached mappings differ from freshly fetched ones')
+
+  report = pd.DataFrame(rows)
+  print(report.to_string(index=False, float_format='{:.2f}'.format))
+  return report
+
+"""Threshold sweeps over many contrasts do not need to rescan res_df for every cutoff. build_stats_index() orders a contrast's genes by padj once and keeps, for each LFC threshold, the padj-ordered positions of the up genes (log2FoldChange >= b) and the down genes (<= -b), with their padj values. A query for (padj <= a, |lfc| >= b) is then a binary search, which gives the number of genes passing, followed by a slice of the k passing rows: O(log n + k). Thresholds listed in lfc_thrs are prepared up front, and any other LFC threshold is added on its first query. query_degs() returns the same up/down frames as filter_degs(), ordered by padj, and count_degs() only the counts. sweep_degs() runs a grid of cutoffs over several contrasts. It maps IDs and runs the enrichment once per distinct gene set, in one map_ids() call and one enrichr_local() pass over all new sets, and keeps those results in a memo dict that later sweeps can reuse. The mapped names are memoized per Biomart dataset (and offline mode) and the enrichment results per gene set library, so one memo can be shared by sweeps over other datasets or libraries without handing back results computed for a different one.
 """
 
-# Run this cell to create DESeq Dataset object as dds_all
-dds_all = DeseqDataSet(
-    counts=counts_df,
-    metadata=clinical_df,
-    design_factors="condition",
-    refit_cooks=True,
-)
-
-# run the deseq2 workflow
-dds_all.deseq2()
+GeneStatsIndex = namedtuple('GeneStatsIndex', ['res_df', 'order', 'padj', 'lfc', 'levels'])
+
+def build_stats_index(res_df, lfc_thrs=(0, 0.5, 1, 1.5, 2, 3)):
+  # genes without an adjusted p-value never pass a padj cutoff, as in filter_degs
+  padj = res_df['padj'].to_numpy(dtype=float)
+  order = np.flatnonzero(~np.isnan(padj))
+  order = order[np.argsort(padj[order], kind='stable')]
+  index = GeneStatsIndex(res_df=res_df, order=order, padj=padj[order],
+                         lfc=res_df['log2FoldChange'].to_numpy(dtype=float)[order], levels={})
+  for lfc_thr in lfc_thrs:
+    _stats_level(index, lfc_thr)
+  return index
+
+def _stats_level(index, lfc_thr):
+  level = index.levels.get(lfc_thr)
+  if level is None:
+    up = np.flatnonzero(index.lfc >= lfc_thr)
+    down = np.flatnonzero(index.lfc <= -lfc_thr)
+    level = index.levels[lfc_thr] = {'up': (up, index.padj[up]), 'down': (down, index.padj[down])}
+  return level
+
+def count_degs(index, padj_thr=0.05, lfc_thr=1):
+  level = _stats_level(index, lfc_thr)
+  return tuple(int(np.searchsorted(level[d][1], padj_thr, side='right')) for d in ('up', 'down'))
+
+def query_degs(index, padj_thr=0.05, lfc_thr=1):
+  level = _stats_level(index, lfc_thr)
+  frames = []
+  for direction in ('up', 'down'):
+    positions, padj = level[direction]
+    k = np.searchsorted(padj, padj_thr, side='right')
+    frames.append(index.res_df.iloc[index.order[positions[:k]]])
+  return tuple(frames)
+
+def _gene_set_key(genes):
+  h = hashlib.blake2b(digest_size=16)
+  h.update('\0'.join(sorted(map(str, genes))).encode())
+  return h.hexdigest()
+
+def _library_key(gene_set_index):
+  return _array_digest('\0'.join(gene_set_index.genes), '\0'.join(gene_set_index.terms),
+                       '\0'.join(gene_set_index.libraries), gene_set_index.matrix.indptr, gene_set_index.matrix.indices)
+
+def sweep_degs(indexes, padj_thrs, lfc_thrs, gene_set_index, memo=None, term_padj_thr=0.05, **map_kwargs):
+  memo = {'names': {}, 'enrichment': {}} if memo is None else memo
+  rows = []
+  for contrast, index in indexes.items():
+    for padj_thr in padj_thrs:
+      for lfc_thr in lfc_thrs:
+        up_degs_df, down_degs_df = query_degs(index, padj_thr=padj_thr, lfc_thr=lfc_thr)
+        for direction, degs_df in (('up', up_degs_df), ('down', down_degs_df)):
+          rows.append({'contrast': contrast, 'padj_thr': padj_thr, 'lfc_thr': lfc_thr, 'direction': direction,
+                       'degs': len(degs_df), 'ids': list(map(str, degs_df.index))})
+
+  # one ID-mapping call for every gene set that has not been mapped before
+  mapping_key = (map_kwargs.get('dataset', BIOMART_DATASET), bool(map_kwargs.get('offline', False)))
+  id_keys = [(*mapping_key, _gene_set_key(row['ids'])) for row in rows]
+  new_sets = {key: row['ids'] for key, row in zip(id_keys, rows) if key not in memo['names']}
+  if new_sets:
+    mapping = map_ids([i for ids in new_sets.values() for i in ids], **map_kwargs)
+    for key, ids in new_sets.items():
+      memo['names'][key] = [mapping[i].upper() for i in ids if mapping[i]]
+
+  # and one enrichment pass over the distinct gene name lists that have not been scored before
+  library_key = _library_key(gene_set_index)
+  name_keys = [_gene_set_key(memo['names'][key]) for key in id_keys]
+  new_lists = {key: memo['names'][id_key] for key, id_key in zip(name_keys, id_keys)
+               if (library_key, key) not in memo['enrichment']}
+  if new_lists:
+    memo['enrichment'].update({(library_key, key): enr for key, enr in enrichr_local(new_lists, gene_set_index).items()})
+
+  for row, id_key, name_key in zip(rows, id_keys, name_keys):
+    del row['ids']
+    enr_res = memo['enrichment'][library_key, name_key].results
+    row.update(mapped_genes=len(memo['names'][id_key]), gene_set=name_key,
+               enriched_terms=int((enr_res['Adjusted P-value'] < term_padj_thr).sum()))
+  sweep = pd.DataFrame(rows)
+  sweep.attrs.update(new_id_sets=len(new_sets), new_gene_lists=len(new_lists))
+  return sweep, memo
+
+"""run_pipeline() runs Tasks 2-11 end to end without a notebook, for every group in the metadata (e.g. every organ) instead of kidney only: loading, DESeq2 on all samples, VST, PCA, the per-group contrasts (in parallel through run_contrasts), DEG filtering, ID mapping and enrichment. Figures are collected instead of shown and exported as static images by a pool of worker processes. The run writes report.html (stage measurements, summary and the interactive figures, with plotly.js inlined so the file is self-contained), report.json, stages.json/stages.csv, the tidy results/enrichment tables and the image files into out_dir. Every step runs inside stage(), and profile_stage names one step to profile with profiler ('cprofile' or 'pyinstrument').
+"""
 
-"""**Task 4**: DeseqDataSet object contains a method for Variance Stabilizing Transformation (use vst() method with default parameters). Apply it to dds_all. We need this method to transform normalized counts, so that we can perform a better PCA.
+def _export_figure(kind, payload, path):
+  if kind == 'plotly':
+    import plotly.io as pio
+    pio.from_json(payload).write_image(path)
+  else:
+    import matplotlib.pyplot as plt
+    from gseapy import dotplot
+    plt.switch_backend('Agg')
+    res2d, title = payload
+    try:
+      dotplot(res2d, title=title, cmap='viridis_r', size=10, figsize=(3,5), ofname=path)
+    except ValueError:
+      # gseapy refuses to draw when no term passes its cutoff
+      return None
+  return path
+
+def export_figures(figures, dotplots, fig_dir, image_format='png', max_workers=None):
+  os.makedirs(fig_dir, exist_ok=True)
+  jobs = [('plotly', fig.to_json(), os.path.join(fig_dir, f'{name}.{image_format}')) for name, fig in figures]
+  jobs += [('dotplot', (res2d, title), os.path.join(fig_dir, f'{name}_dotplot.png'))
+           for name, (res2d, title) in dotplots.items()]
+  with ProcessPoolExecutor(max_workers=max_workers) as pool:
+    paths = list(pool.map(_export_figure, *zip(*jobs))) if jobs else []
+  return [path for path in paths if path is not None]
+
+def write_report(report, figures, out_dir):
+  with open(os.path.join(out_dir, 'report.json'), 'w') as f:
+    json.dump(report, f, indent=2, default=str)
+
+  stages = pd.DataFrame(report['stages']).to_html(index=False, float_format='{:.2f}'.format, na_rep='')
+  summary = pd.DataFrame(report['contrasts']).to_html(index=False)
+  parts = [f"<html><head><meta charset='utf-8'><title>{report['title']}</title></head><body>",
+           f"<h1>{report['title']}</h1><h2>Stages</h2>{stages}<h2>Contrasts</h2>{summary}"]
+  for i, (name, fig) in enumerate(figures):
+    parts.append(f'<h3>{name}</h3>' + fig.to_html(full_html=False, include_plotlyjs='inline' if i == 0 else False))
+  for path in report['figure_files']:
+    if path.endswith('_dotplot.png'):
+      with open(path, 'rb') as f:
+        encoded = base64.b64encode(f.read()).decode()
+      parts.append(f"<h3>{os.path.basename(path)}</h3><img src='data:image/png;base64,{encoded}'>")
+  parts.append('</body></html>')
+
+  html_path = os.path.join(out_dir, 'report.html')
+  with open(html_path, 'w') as f:
+    f.write('\n'.join(parts))
+  return html_path
+
+def run_pipeline(counts_path='counts.tsv', clinical_path='clinical.tsv', out_dir='report', study='GSE117167',
+                 min_count=10, group_col='organ', factor='condition', tested='cis', ref='untrt',
+                 padj_thr=0.05, lfc_thr=1, nTop=500, library='GO_Biological_Process_2021', organism='Mouse',
+                 max_workers=None, image_format='png', profile_stage=None, profiler='cprofile'):
+  from pydeseq2.dds import DeseqDataSet
+  os.makedirs(out_dir, exist_ok=True)
+  stages = []
+  contrast = f'{factor}_{tested}_vs_{ref}'
+
+  def pipeline_stage(name, **sizes):
+    return stage(name, log=stages, profile=profiler if name == profile_stage else None,
+                 profile_dir=out_dir, **sizes)
+
+  with collect_figures() as figures:
+    with pipeline_stage('load') as record:
+      clinical_df = pd.read_csv(clinical_path, sep='\t').set_index('sampleID').sort_index(ascending=True)
+      counts_df = load_counts_cached(counts_path, clinical_df, clinical_path=clinical_path, min_count=min_count)
+      record['samples'], record['genes'] = counts_df.shape
+
+    n_samples, n_genes = counts_df.shape
+    with pipeline_stage('deseq2_all', samples=n_samples, genes=n_genes):
+      dds_all = DeseqDataSet(counts=counts_df, metadata=clinical_df, design_factors=factor, refit_cooks=True)
+      dds_all.deseq2()
+
+    with pipeline_stage('vst', samples=n_samples, genes=n_genes):
+      cached_vst(dds_all)
+
+    with pipeline_stage('pca', samples=n_samples, genes=min(nTop, n_genes) if nTop else n_genes):
+      plotPCA(dds_all, clinical_df, nTop=nTop, name='pca')
+
+    n_groups = clinical_df[group_col].nunique()
+    with pipeline_stage('contrasts', samples=n_samples, genes=n_genes, groups=n_groups):
+      all_res_df = run_contrasts(counts_df, clinical_df, study=study, group_col=group_col,
+                                 factor=factor, tested=tested, ref=ref, max_workers=max_workers)
+      all_res_df.to_csv(os.path.join(out_dir, 'results.tsv'), sep='\t', index=False)
+
+    gene_col = counts_df.columns.name or 'geneIDs'
+    deg_ids = {}
+    with pipeline_stage('contrast_plots_and_degs', genes=n_genes, groups=n_groups) as record:
+      for group, res_df in all_res_df.groupby(group_col, sort=True):
+        res_df = res_df.set_index(gene_col)
+        shrunken = StatsSnapshot(dds=None, results_df=res_df)
+        unshrunken = StatsSnapshot(dds=None, results_df=res_df.assign(log2FoldChange=res_df['log2FoldChange_unshrunken']))
+        plotDispEsts(res_df=res_df, name=f'{group}_dispersion')
+        plotMA(shrunken, padj_thr=padj_thr, name=f'{group}_ma_shrunken')
+        plotMA(unshrunken, padj_thr=padj_thr, name=f'{group}_ma_unshrunken')
+        plotVolcano(shrunken, lfc_thr=[-lfc_thr, lfc_thr], padj_thr=padj_thr, name=f'{group}_volcano')
+
+        up_degs_df, down_degs_df = filter_degs(shrunken, padj_thr=padj_thr, lfc_thr=lfc_thr)
+        deg_ids[f'{group}_up'] = list(up_degs_df.index)
+        deg_ids[f'{group}_down'] = list(down_degs_df.index)
+      record['degs'] = sum(map(len, deg_ids.values()))
+
+  with pipeline_stage('map_ids', degs=sum(map(len, deg_ids.values()))) as record:
+    id_stats = {}
+    mapping = map_ids([i for ids in deg_ids.values() for i in ids], stats=id_stats)
+    gene_lists = {name: [mapping[i].upper() for i in ids if mapping[i]] for name, ids in deg_ids.items()}
+    record.update(ids=id_stats['ids'], cache_hits=id_stats['cache_hits'], batches=id_stats['batches'])
+
+  with pipeline_stage('enrichment', gene_lists=len(gene_lists), genes=sum(map(len, gene_lists.values()))):
+    enr = enrichr_local(gene_lists, load_library(library, organism=organism))
+    enr_df = pd.concat({name: e.results for name, e in enr.items()}, names=['gene_list']).reset_index(0)
+    enr_df.to_csv(os.path.join(out_dir, 'enrichment.tsv'), sep='\t', index=False)
+
+  dotplots = {name: (e.res2d, f'{name} - {library}') for name, e in enr.items() if len(e.res2d)}
+  with pipeline_stage('export_figures', figures=len(figures) + len(dotplots)):
+    figure_files = export_figures(figures, dotplots, os.path.join(out_dir, 'figures'),
+                                  image_format=image_format, max_workers=max_workers)
+
+  write_stage_log(stages, os.path.join(out_dir, 'stages.json'))
+  write_stage_log(stages, os.path.join(out_dir, 'stages.csv'))
+  report = {
+      'title': f'{study}: {contrast} by {group_col}',
+      'stages': stages,
+      'contrasts': [{group_col: name.rsplit('_', 1)[0], 'direction': name.rsplit('_', 1)[1],
+                     'degs': len(deg_ids[name]), 'mapped_genes': len(gene_lists[name]),
+                     'enriched_terms': int((enr[name].results['Adjusted P-value'] < padj_thr).sum())}
+                    for name in deg_ids],
+      'figure_files': figure_files,
+  }
+  write_report(report, figures, out_dir)
+  return report
+
+"""The benchmark suite below measures the analysis on synthetic data of a known size. simulate_counts() writes counts.tsv/clinical.tsv in the same layout as the GSE117167 files (genes as rows under a geneIDs index; sampleID, organ and condition columns). Counts are drawn from a negative binomial with a DESeq2-like mean-dispersion trend, per-sample size factors, organ-specific expression and a fraction of genes changed by the treatment in each organ. run_benchmarks() generates one dataset per scale, where 1x is the real cohort (3 organs x 2 conditions x 2 replicates) and 10x/100x multiply the replicates. It then times loading and filtering, deseq2(), vst(), the plotPCA data prep, the Wald test, DEG filtering and enrichment against a synthetic gene set library with stage(). The records, together with the package versions and machine, are written to a JSON file, and compare_benchmarks() lines up two such files stage by stage to spot regressions.
+"""
 
-Hint: [Check how to with the docs](https://pydeseq2.readthedocs.io/en/latest/api/docstrings/pydeseq2.dds.DeseqDataSet.html#pydeseq2.dds.DeseqDataSet.vst)
+def simulate_counts(counts_path='counts.tsv', clinical_path='clinical.tsv', n_genes=30000, replicates=2,
+                    organs=('kidney', 'liver', 'lung'), conditions=('cis', 'untrt'), de_fraction=0.05,
+                    organ_fraction=0.2, chunksize=5000, seed=0):
+  rng = np.random.default_rng(seed)
+  genes = pd.Index([f'ENSMUSG{i:011d}' for i in range(n_genes)], name='geneIDs')
+  groups = [(organ, condition) for organ in organs for condition in conditions]
+  clinical_df = pd.DataFrame([(organ, condition) for organ, condition in groups for _ in range(replicates)],
+                             columns=['organ', 'condition'])
+  clinical_df.index = pd.Index([f'GSM{i:07d}' for i in range(len(clinical_df))], name='sampleID')
+
+  # baseline means spread over several orders of magnitude, dispersion falling with the mean
+  base_mean = rng.lognormal(mean=3.5, sigma=2.0, size=n_genes)
+  dispersion = (0.05 + 1 / base_mean) * rng.lognormal(sigma=0.5, size=n_genes)
+  truth = pd.DataFrame({'base_mean': base_mean, 'dispersion': dispersion}, index=genes)
+  organ_lfc = {}
+  for organ in organs:
+    lfc = np.zeros(n_genes)
+    changed = rng.random(n_genes) < organ_fraction
+    lfc[changed] = rng.normal(0, 1.5, changed.sum())
+    organ_lfc[organ] = lfc
+    treated = rng.random(n_genes) < de_fraction
+    truth[f'lfc_{organ}'] = np.where(treated, rng.choice([-1, 1], n_genes) * rng.uniform(1, 3, n_genes), 0.0)
+
+  size_factors = rng.lognormal(sigma=0.2, size=len(clinical_df))
+  counts = np.empty((n_genes, len(clinical_df)), dtype=np.uint32)
+  for j, (organ, condition) in enumerate(zip(clinical_df['organ'], clinical_df['condition'])):
+    lfc = organ_lfc[organ] + (truth[f'lfc_{organ}'].to_numpy() if condition == conditions[0] else 0)
+    mu = size_factors[j] * base_mean * 2.0 ** lfc
+    n = 1 / dispersion
+    counts[:, j] = np.minimum(rng.negative_binomial(n, n / (n + mu)), np.iinfo(np.uint32).max)
+
+  with open(counts_path, 'w') as f:
+    f.write('\t'.join(['geneIDs', *clinical_df.index]) + '\n')
+    for start in range(0, n_genes, chunksize):
+      pd.DataFrame(counts[start:start + chunksize], index=genes[start:start + chunksize]).to_csv(
+          f, sep='\t', header=False)
+  clinical_df.to_csv(clinical_path, sep='\t')
+  return truth
+
+def simulate_gene_sets(genes, n_terms=2000, min_size=10, max_size=300, seed=0):
+  rng = np.random.default_rng(seed)
+  genes = np.asarray([str(g).upper() for g in genes])
+  sizes = rng.integers(min_size, min(max_size, len(genes)) + 1, n_terms)
+  return {f'SYNTHETIC_TERM_{t}': list(rng.choice(genes, size, replace=False)) for t, size in enumerate(sizes)}
+
+def _bench_meta(params):
+  versions = {}
+  for package in ['numpy', 'pandas', 'scipy', 'scikit-learn', 'pydeseq2', 'anndata']:
+    try:
+      versions[package] = metadata.version(package)
+    except metadata.PackageNotFoundError:
+      versions[package] = None
+  return {
+      'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'cpu_count': os.cpu_count(),
+      'versions': versions,
+      'params': params,
+  }
+
+def run_benchmarks(scales=(1, 10, 100), n_genes=30000, replicates=2, repeat=1, data_dir='bench_data',
+                   out_path='bench_results.json', min_count=10, padj_thr=0.05, lfc_thr=1, nTop=500,
+                   n_terms=2000, n_cpus=None, seed=0):
+  # taken before the imports below, which would otherwise end up in locals()
+  params = dict(locals())
+  from pydeseq2.dds import DeseqDataSet
+  from pydeseq2.ds import DeseqStats
+  records = []
+  for scale in scales:
+    scale_dir = os.path.join(data_dir, f'{scale}x_{n_genes}genes_{replicates}reps_seed{seed}')
+    counts_path = os.path.join(scale_dir, 'counts.tsv')
+    clinical_path = os.path.join(scale_dir, 'clinical.tsv')
+    if not (os.path.exists(counts_path) and os.path.exists(clinical_path)):
+      os.makedirs(scale_dir, exist_ok=True)
+      simulate_counts(counts_path, clinical_path, n_genes=n_genes, replicates=replicates * scale, seed=seed)
+    gene_set_index = load_gene_sets({'SYNTHETIC': simulate_gene_sets(
+        pd.read_csv(counts_path, sep='\t', usecols=[0]).iloc[:, 0], n_terms=n_terms, seed=seed)})
+
+    # pydeseq2 prints its progress and the results table; keep that out of the timings
+    with redirect_stdout(io.StringIO()):
+      for run in range(repeat):
+        log = []
+        with stage('load_filter', log=log) as record:
+          clinical_df = pd.read_csv(clinical_path, sep='\t').set_index('sampleID').sort_index(ascending=True)
+          counts_df = load_counts(counts_path, clinical_df, min_count=min_count, verbose=False)
+          record['samples'], record['genes'] = counts_df.shape
+        sizes = {'samples': counts_df.shape[0], 'genes': counts_df.shape[1]}
+
+        with stage('deseq2', log=log, **sizes):
+          dds = DeseqDataSet(counts=counts_df, metadata=clinical_df, design_factors='condition',
+                             refit_cooks=True, ref_level=['condition', 'untrt'], n_cpus=n_cpus, quiet=True)
+          dds.deseq2()
+
+        with stage('vst', log=log, **sizes):
+          dds.vst()
+
+        with stage('pca_prep', log=log, samples=sizes['samples'], genes=min(nTop, sizes['genes'])):
+          pca_stage(dds, nTop=nTop)
+
+        with stage('wald_test', log=log, **sizes):
+          stat_res = DeseqStats(dds, contrast=['condition', 'cis', 'untrt'], n_cpus=n_cpus, quiet=True)
+          stat_res.summary()
+
+        with stage('deg_filter', log=log, **sizes) as record:
+          up_degs_df, down_degs_df = filter_degs(stat_res, padj_thr=padj_thr, lfc_thr=lfc_thr)
+          record['degs'] = len(up_degs_df) + len(down_degs_df)
+
+        gene_lists = {'up': list(up_degs_df.index), 'down': list(down_degs_df.index)}
+        with stage('enrichment', log=log, gene_lists=len(gene_lists), genes=sum(map(len, gene_lists.values())),
+                   terms=len(gene_set_index.terms)):
+          enrichr_local(gene_lists, gene_set_index)
+
+        records += [{'scale': scale, 'run': run, **record} for record in log]
+        del dds, stat_res, counts_df
+
+  results = {'meta': _bench_meta(params), 'results': records}
+  with open(out_path, 'w') as f:
+    json.dump(results, f, indent=2, default=str)
+  return pd.DataFrame(records)
+
+def compare_benchmarks(baseline_path, current_path, metric='wall_seconds', threshold=1.2):
+  def medians(path):
+    with open(path) as f:
+      results = pd.DataFrame(json.load(f)['results'])
+    return results.groupby(['scale', 'stage'], sort=False)[metric].median()
+
+  comparison = pd.concat({'baseline': medians(baseline_path), 'current': medians(current_path)}, axis=1)
+  comparison['ratio'] = comparison['current'] / comparison['baseline']
+  comparison['regression'] = comparison['ratio'] > threshold
+  return comparison
+
+"""run_notebook() is the Task 1-11 walkthrough below. It only runs when called, e.g. from a notebook cell or with python geneExpression.py notebook, so importing this file does not start an analysis.
 """
 
-# Transform the normalized counts by Variance Stabilizing Transformation (vst) for PCA
+def run_notebook(counts_path='counts.tsv', clinical_path='clinical.tsv'):
+  import gseapy as gp
+  from gseapy import dotplot
+  from pydeseq2.dds import DeseqDataSet
+  from pydeseq2.ds import DeseqStats
 
-dds_all.vst()
+  """Download the dge-data.zip file from SUCourse and extract. You will find two text files. Upload them on this colab notebook. Run the below cell.
 
-# and also run here, you should see 'vst_counts' in "layers"
-dds_all
+  **Task 1**: Print the two dataframes that you have imported. What do you see, describe both of the dataframes.
+  """
 
-"""**Task 5**: Run the following cell to perform PCA and plot the results. Interpret the results with respect to biological relevance. (Such as in the contrast of different organs and treatment presence etc.)"""
+  clinical_df = pd.read_csv(clinical_path, sep='\t')
+  clinical_df = clinical_df.set_index('sampleID')
+  clinical_df = clinical_df.sort_index(ascending=True)
 
-plotPCA(dds_all, clinical_df, nTop=500, returnData=False)
+  # Streams counts.tsv and applies the Task 2 low-count filter while reading;
+  # later runs memory-map the cached matrix instead of parsing the text again
+  # (each heavy cell below runs inside stage(), which records its time, memory and input sizes in STAGE_LOG)
+  with stage('load') as record:
+    counts_df = load_counts_cached(counts_path, clinical_df, clinical_path=clinical_path, min_count=10)
+    record['samples'], record['genes'] = counts_df.shape
 
-"""<< There are 3 major clusters that have formed, 1 for the lung (shown in green), 1 for the liver (shown in red) and one for the kidney (shown in blue). These were 2 replicates used for each of the conditions (cis, representing the mouse organs treated with cisplatin, and untrt which represents the untreated population). This shows that these 3 cell types show differential gene expression when compared to each other, but the treated and untreated versions of each of the organs are still close enough in gene expression so that they can be clustered together. It seems that the within-group variability for the kidney cells is low, since the points seem closer together than in the case of lung and liver. When it comes to the separation between the treated and untreated samples, there isn't a clear pattern, since the treated samples are far away from each other in the liver and the lung, and there isn't a clear separation between the untreated and treated cells of any of the organ types that can be seen, except for the fact that the untreated samples lie lower on the graph than the treated samples when it comes to the kidney and lung cells. >>
+  # PRINT CLINICAL DF
 
-**Task 6**: We want to perform differential expression analysis to understand the effects of cisplatin treatment on kidney. Filter the clinical_df, where you only keep the rows that the organ is kidney. Filter the counts_df accordingly. Create a new DeseqDataset object with new filtered data, and assign it to dds.
+  print(clinical_df)
 
-Dont forget to use **ref_level** parameter this time (It is a parameter in DeseqDataSet function). Because we want our base level to be untreated samples. So that, positive fold changes of expression will be the genes that are upregulated after cisplatin treatment, and negative fold changes of expression will be the genes that are downregulated after cisplatin treatment.
+  # PRINT COUNTS DF
 
-Hint: Be careful with the DataFrame indexes. They should match between counts and metadata.
+  print(counts_df)
 
-Hint2: [Check how to with the docs](https://pydeseq2.readthedocs.io/en/latest/api/docstrings/pydeseq2.dds.DeseqDataSet.html#pydeseq2.dds.DeseqDataSet)
-"""
 
-df_kidney_clinical = clinical_df[clinical_df.iloc[:,0]== 'kidney'] ##df[df['hi'] == specific_value]
 
-df_kidney_counts = counts_df.loc[['GSM3272779','GSM3272780' ,'GSM3272781' , 'GSM3272782']]
+  """<< The clinical_df shows the true labels of each of the samples with the sample ids and the labels, which include the organ names and the condition (untrt = untreated and cis=cisplatin-treated). The counts_df shows the gene expression levels observed in the experiments with all of the samples for each of the different genes, which have different ids listed in the gene_ids row.>>
 
+  **Task 2**: Keep only the columns in the counts_df that the sum of the counts are bigger or equal than 10 for each gene. We want to eliminate genes which produced very low counts across all samples.
+  """
 
-dds = DeseqDataSet(
-    counts=df_kidney_counts,
-    metadata=df_kidney_clinical,
-    design_factors="condition",
-    refit_cooks=True,
-    ref_level=["condition","untrt"],
-)
+  #Filter out genes that have less than 10 counts across samples
+  # (already applied by load_counts(min_count=10) above, so no extra dense copy is made here)
 
+  if not (counts_df.sum() >= 10).all():
+    raise ValueError('counts_df still holds genes with fewer than 10 counts')
+  print(counts_df.shape)
 
+  # For mostly-zero tables, keep the counts sparse through the filter and the normalization and only
+  # densify the samples and genes a DeseqDataSet needs, e.g.:
+  # sparse_counts = load_counts_sparse('counts.tsv', clinical_df, min_count=10)
+  # normed = sparse_normed_counts(sparse_counts)
+  # counts_df = densify_counts(sparse_counts, samples=clinical_df.index[clinical_df['organ'] == 'kidney'], min_count=10)
+  # bench_sparse_memory() compares the memory of both paths at several sparsity levels
 
+  """**Task 3**: You are going to create DeseqDataSet object from your counts_df and clinical_df. DeseqDataSet object contains the methods for DESeq2 workflow and necessary transformations.
 
+  Go to this [link](https://pydeseq2.readthedocs.io/en/latest/auto_examples/plot_minimal_pydeseq2_pipeline.html#sphx-glr-auto-examples-plot-minimal-pydeseq2-pipeline-py)
 
-# Run DESeq2 workflow to Perform dispersion and log fold-change (LFC) estimation.
-dds.deseq2()
+  Try to understand how to create DeseqDataSet object.
+  """
 
-"""**Task7**: Go to the [link](https://hbctraining.github.io/DGE_workshop/lessons/04_DGE_DESeq2_analysis.html). Do not try to use the code in the link -on here- because it is for original implementation of DESeq2 in R. Try to understand how DESeq2 controls dispersion. Run the following cell to plot dispersion plot. Do you think the data is a good fit for the DESeq2 model? Explain what you see."""
+  # Run this cell to create DESeq Dataset object as dds_all
+  dds_all = DeseqDataSet(
+      counts=counts_df,
+      metadata=clinical_df,
+      design_factors="condition",
+      refit_cooks=True,
+  )
 
-# Plot dispersions
-plotDispEsts(dds)
+  # run the deseq2 workflow
+  with stage('deseq2_all', samples=dds_all.n_obs, genes=dds_all.n_vars):
+    dds_all.deseq2()
 
-"""<< According to the website provided, the dispersion is inversely proportional to the mean counts, and this is true to a good extent here, since majority of the samples fit the model in the graph. But, there are many samples that have small dispersion (of around 18.42) which have varying mean_norm_counts. Also, the negative slope isn't very steep, which may be another indicator that the data actually doesn't fit this model well. >>"""
+  """**Task 4**: DeseqDataSet object contains a method for Variance Stabilizing Transformation (use vst() method with default parameters). Apply it to dds_all. We need this method to transform normalized counts, so that we can perform a better PCA.
 
-# # Run this cell for the statistical tests for differential expression and lfc shrink
-stat_res = DeseqStats(dds)
-stat_res.summary()
-stat_res_unshrunken = copy.deepcopy(stat_res)
-# Shrink lfc
-stat_res.lfc_shrink(coeff="condition_cis_vs_untrt")
+  Hint: [Check how to with the docs](https://pydeseq2.readthedocs.io/en/latest/api/docstrings/pydeseq2.dds.DeseqDataSet.html#pydeseq2.dds.DeseqDataSet.vst)
+  """
 
-"""**Task8**: Go to this [link](https://hbctraining.github.io/DGE_workshop/lessons/05_DGE_DESeq2_analysis2.html) Try to understand statistical analysis that is performed by DESeq2 and how log2 foldchange shrinkage is applied. Next, Plot MA plot for shrunken lfc and unshrunken lfc. What do you see different?
+  # Transform the normalized counts by Variance Stabilizing Transformation (vst) for PCA
+  # (cached on disk, so later sessions reuse the transform instead of recomputing it)
 
-Do not try to use the code in the link -on here- because it is for original implementation of DESeq2 in R.
-"""
+  with stage('vst', samples=dds_all.n_obs, genes=dds_all.n_vars):
+    cached_vst(dds_all)
 
-#MA Plot for shrunken lfc
-plotMA(stat_res, padj_thr=0.05)
+  # and also run here, you should see 'vst_counts' in "layers"
+  print(dds_all)
 
-#MA Plot for unshrunken lfc
-plotMA(stat_res_unshrunken, padj_thr=0.05)
+  """**Task 5**: Run the following cell to perform PCA and plot the results. Interpret the results with respect to biological relevance. (Such as in the contrast of different organs and treatment presence etc.)"""
 
-"""<< The two graphs are very different: the unshrunken version includes noisy data, hence the data is more dispersed, and this is especially true for the low mean of normalized counts as can be seen in the plot (this means that at lower levels of differential expression, there is higher variance in the lfc) - while the shrunken version, where the noisy measurements have been removed and the estimates are closer to 0, the data is more uniform and less dispersed.>>
+  with stage('pca', samples=dds_all.n_obs, genes=500):
+    plotPCA(dds_all, clinical_df, nTop=500, returnData=False)
 
-Volcano plot is a great way to get an overall picture of what is going on, where we plot the log transformed adjusted p-values plotted on the y-axis and log2 fold change values on the x-axis.
-"""
+  """<< There are 3 major clusters that have formed, 1 for the lung (shown in green), 1 for the liver (shown in red) and one for the kidney (shown in blue). These were 2 replicates used for each of the conditions (cis, representing the mouse organs treated with cisplatin, and untrt which represents the untreated population). This shows that these 3 cell types show differential gene expression when compared to each other, but the treated and untreated versions of each of the organs are still close enough in gene expression so that they can be clustered together. It seems that the within-group variability for the kidney cells is low, since the points seem closer together than in the case of lung and liver. When it comes to the separation between the treated and untreated samples, there isn't a clear pattern, since the treated samples are far away from each other in the liver and the lung, and there isn't a clear separation between the untreated and treated cells of any of the organ types that can be seen, except for the fact that the untreated samples lie lower on the graph than the treated samples when it comes to the kidney and lung cells. >>
 
-#Volcano Plot
-plotVolcano(stat_res)
+  **Task 6**: We want to perform differential expression analysis to understand the effects of cisplatin treatment on kidney. Filter the clinical_df, where you only keep the rows that the organ is kidney. Filter the counts_df accordingly. Create a new DeseqDataset object with new filtered data, and assign it to dds.
 
-"""Inspect the results table (res_df) that is created after statistical tests."""
+  Dont forget to use **ref_level** parameter this time (It is a parameter in DeseqDataSet function). Because we want our base level to be untreated samples. So that, positive fold changes of expression will be the genes that are upregulated after cisplatin treatment, and negative fold changes of expression will be the genes that are downregulated after cisplatin treatment.
 
-res_df = stat_res.results_df
-res_df
+  Hint: Be careful with the DataFrame indexes. They should match between counts and metadata.
 
-"""**Task9:**
+  Hint2: [Check how to with the docs](https://pydeseq2.readthedocs.io/en/latest/api/docstrings/pydeseq2.dds.DeseqDataSet.html#pydeseq2.dds.DeseqDataSet)
+  """
 
-What does fold change mean? Where is p-value coming from? What is padj (Adjusted p-value)? What is Multiple test correction? Check again the link in Task8.
+  df_kidney_clinical = clinical_df[clinical_df.iloc[:,0]== 'kidney'] ##df[df['hi'] == specific_value]
 
-Filter the res_df where padj is smaller or equal to .05. So that we get differentially expressed genes that statistically significant.
+  df_kidney_counts = counts_df.loc[df_kidney_clinical.index]
 
-Then,
 
-Filter the res_df where log2FoldChange is bigger or equal than 1, and assign it to up_degs. (Up regulated genes where fold change is 2 times changed, log2foldchange 1 means 2)
+  dds = DeseqDataSet(
+      counts=df_kidney_counts,
+      metadata=df_kidney_clinical,
+      design_factors="condition",
+      refit_cooks=True,
+      ref_level=["condition","untrt"],
+  )
 
-Filter the res_df where log2FoldChange is smaller or equal than -1, and assign it to down_degs. (Down regulated genes where fold change is halfed, log2foldchange -1 means .5)
 
-<< The fold change shows the differenential expression ratio between 2 conditions (in this case, the treated vs. the untreated condition). The p-value is coming from the Wald test. The adjusted p-value comes from using the Benjamini-Hochberg method, where each gene is ranked by the p-value and each p-value is multiplied by (the total number of tests/rank). Multiple test correction is needed whenever there are many tests being performed because if we take the p-value and use some cut-off value (i.e: 0.05), there would be a cumulative effect where each of the tests would have a small chance of having false positives which would add up to be a big value at the end (i.e: if we have 10 tests and we use 0.05 as our cut-off value, it results in 10*0.05 = 0.5 false positives, which means theres a 50% chance of getting false positives), so we use multiple test correction to pick the true positives.>>
-"""
 
-# filter the res_df based on log2FC and Adjusted p-value as described above
-res_df = res_df[res_df['padj']<=0.05]
-up_degs_df = res_df[res_df['log2FoldChange']>=1]
-down_degs_df = res_df[res_df['log2FoldChange']<=-1]
 
-"""After obtaining gene sets (dataframes) of upregulated and downregulated genes, we will perform gene set enrichment, with EnrichR api inside GSEApy. EnrichR needs Entrez Gene names instead of Ensembl gene ids. Think of it as different databases name genes differently.
 
-Run the following cell.
-"""
+  # Run DESeq2 workflow to Perform dispersion and log fold-change (LFC) estimation.
+  with stage('deseq2_kidney', samples=dds.n_obs, genes=dds.n_vars):
+    dds.deseq2()
 
-# Convert ensembl gene ids to Entrez Gene Names using biomart api inside gseapy via batch submission
+  # The same cis vs untrt contrast for the other organs, run in parallel worker processes
+  # (kidney is analysed step by step in the cells below)
+  other_clinical_df = clinical_df[clinical_df['organ'] != 'kidney']
+  with stage('contrasts', samples=len(other_clinical_df), genes=counts_df.shape[1],
+             groups=other_clinical_df['organ'].nunique()):
+    other_res_df = run_contrasts(counts_df, other_clinical_df, study='GSE117167', group_col='organ', max_workers=2)
+  other_degs_df = other_res_df[other_res_df['padj'] <= 0.05]
+  print(other_degs_df.groupby('organ')['log2FoldChange'].agg(up=lambda lfc: (lfc >= 1).sum(),
+                                                           down=lambda lfc: (lfc <= -1).sum()))
 
-def chunks(lst, n):
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+  """**Task7**: Go to the [link](https://hbctraining.github.io/DGE_workshop/lessons/04_DGE_DESeq2_analysis.html). Do not try to use the code in the link -on here- because it is for original implementation of DESeq2 in R. Try to understand how DESeq2 controls dispersion. Run the following cell to plot dispersion plot. Do you think the data is a good fit for the DESeq2 model? Explain what you see."""
 
-def batch_subs(degs, n=200):
-  bm = Biomart()
+  # Plot dispersions
+  plotDispEsts(dds)
 
-  gene_names = []
-  for batch in chunks(degs, n):
+  """<< According to the website provided, the dispersion is inversely proportional to the mean counts, and this is true to a good extent here, since majority of the samples fit the model in the graph. But, there are many samples that have small dispersion (of around 18.42) which have varying mean_norm_counts. Also, the negative slope isn't very steep, which may be another indicator that the data actually doesn't fit this model well. >>"""
 
-    queries ={'ensembl_gene_id': batch }
-    results = bm.query(dataset='mmusculus_gene_ensembl',
-                      attributes=['entrezgene_accession'],
-                      filters=queries)
-    gene_names += list(results['entrezgene_accession'])
+  # # Run this cell for the statistical tests for differential expression and lfc shrink
+  stat_res = DeseqStats(dds)
+  with stage('wald_test', samples=dds.n_obs, genes=dds.n_vars):
+    stat_res.summary()
+  # keep only the unshrunken results columns (and a reference to dds) instead of deep-copying stat_res
+  stat_res_unshrunken = snapshot_stats(stat_res)
+  # Shrink lfc
+  # (pass profile='cprofile' to stage() to also write a profile of this one step to lfc_shrink.prof)
+  with stage('lfc_shrink', samples=dds.n_obs, genes=dds.n_vars):
+    stat_res.lfc_shrink(coeff="condition_cis_vs_untrt")
 
-  return [i.upper() for i in gene_names]
+  """**Task8**: Go to this [link](https://hbctraining.github.io/DGE_workshop/lessons/05_DGE_DESeq2_analysis2.html) Try to understand statistical analysis that is performed by DESeq2 and how log2 foldchange shrinkage is applied. Next, Plot MA plot for shrunken lfc and unshrunken lfc. What do you see different?
 
-gene_names_up = batch_subs(up_degs_df.index)
-gene_names_down = batch_subs(down_degs_df.index)
+  Do not try to use the code in the link -on here- because it is for original implementation of DESeq2 in R.
+  """
 
-"""Also run the following cell to briefly inspect the API returns of Entrez gene names for corresponding gene ids for the first 5 of them, and the total length of the corresponding lists."""
+  #MA Plot for shrunken lfc
+  plotMA(stat_res, padj_thr=0.05)
 
-gene_names_up[:5], len(set(gene_names_up)), gene_names_down[:5], len(set(gene_names_down))
+  #MA Plot for unshrunken lfc
+  plotMA(stat_res_unshrunken, padj_thr=0.05)
 
-"""**Task10**: Run the following cell. You will see all of the Mouse gene set libraries that are present within EnrichR. You will see a lot of GO and KEGG database names with different years of version. What is [GO](http://geneontology.org/) database? GO is spllited into 3 major ontologies; Molecular Function, Cellular Component, Biological Process, what are they and how are they different? What is [KEGG](https://www.genome.jp/kegg/pathway.html) pathway database?"""
+  # Optional: compare the memory kept by copy.deepcopy(stat_res) and snapshot_stats(stat_res) on a synthetic 30k-gene dataset
+  # bench_snapshot_memory(n_genes=30000)
 
-# Check out libraries that are present for Mouse
-gp.get_library_name(organism='Mouse')
+  """<< The two graphs are very different: the unshrunken version includes noisy data, hence the data is more dispersed, and this is especially true for the low mean of normalized counts as can be seen in the plot (this means that at lower levels of differential expression, there is higher variance in the lfc) - while the shrunken version, where the noisy measurements have been removed and the estimates are closer to 0, the data is more uniform and less dispersed.>>
 
-"""<< The GO database has annotated genes (with 'GO terms') that represent the products and the function of the gene. The factors used to make the GO terms are Molecular Function, Cellular Component, Biological Process. Molecular function refers to the role of the gene in the cell. The activities performed by the gene products are represented by this. The cellular component is the location of the gene - this can be (1) the "cellular anatomical entities" which includes the cellular structures where the function of the gene products is carried out, and (2) the macromolecular complexes the gene products are a part of. Lastly, the Biological Process refers to the big processes the gene products are a part of, where multiple molecular activities work together to finish the process (it is to be noted that this isn't a pathway, but rather the process the gene products are a part of). The KEGG pathway database is a collection of pathways, each of which are represented by a 2-4 letter prefix code and 5-digit number.>>
+  Volcano plot is a great way to get an overall picture of what is going on, where we plot the log transformed adjusted p-values plotted on the y-axis and log2 fold change values on the x-axis.
+  """
 
-Run the following 4 cells, where we are going to use library of **GO_Biological_Process_2021** with our **Over-representation analysis.**
-"""
+  #Volcano Plot
+  plotVolcano(stat_res)
+
+  """Inspect the results table (res_df) that is created after statistical tests."""
+
+  res_df = stat_res.results_df
+  print(res_df)
+
+  """**Task9:**
+
+  What does fold change mean? Where is p-value coming from? What is padj (Adjusted p-value)? What is Multiple test correction? Check again the link in Task8.
+
+  Filter the res_df where padj is smaller or equal to .05. So that we get differentially expressed genes that statistically significant.
+
+  Then,
+
+  Filter the res_df where log2FoldChange is bigger or equal than 1, and assign it to up_degs. (Up regulated genes where fold change is 2 times changed, log2foldchange 1 means 2)
+
+  Filter the res_df where log2FoldChange is smaller or equal than -1, and assign it to down_degs. (Down regulated genes where fold change is halfed, log2foldchange -1 means .5)
+
+  << The fold change shows the differenential expression ratio between 2 conditions (in this case, the treated vs. the untreated condition). The p-value is coming from the Wald test. The adjusted p-value comes from using the Benjamini-Hochberg method, where each gene is ranked by the p-value and each p-value is multiplied by (the total number of tests/rank). Multiple test correction is needed whenever there are many tests being performed because if we take the p-value and use some cut-off value (i.e: 0.05), there would be a cumulative effect where each of the tests would have a small chance of having false positives which would add up to be a big value at the end (i.e: if we have 10 tests and we use 0.05 as our cut-off value, it results in 10*0.05 = 0.5 false positives, which means theres a 50% chance of getting false positives), so we use multiple test correction to pick the true positives.>>
+  """
+
+  # filter the res_df based on log2FC and Adjusted p-value as described above
+  up_degs_df, down_degs_df = filter_degs(stat_res, padj_thr=0.05, lfc_thr=1)
+
+  """After obtaining gene sets (dataframes) of upregulated and downregulated genes, we will perform gene set enrichment, with EnrichR api inside GSEApy. EnrichR needs Entrez Gene names instead of Ensembl gene ids. Think of it as different databases name genes differently.
+
+  Run the following cell.
+  """
+
+  # Convert ensembl gene ids to Entrez Gene Names using the biomart api via batch submission
+  # (map_ids() looks up the local SQLite cache first and only sends new ids to biomart)
 
-# Up-regulated genes, cis vs untrt
-enr_up = gp.enrichr(gene_list=gene_names_up,
-                 gene_sets=['GO_Biological_Process_2021'],
-                 organism='mouse',
-                 outdir=None,
-                )
-enr_res_up = enr_up.results
+  id_stats = {}
+  with stage('map_ids', degs=len(up_degs_df) + len(down_degs_df)) as record:
+    gene_names_up = batch_subs(up_degs_df.index, stats=id_stats)
+    record['batches'] = id_stats['batches']
+    gene_names_down = batch_subs(down_degs_df.index, stats=id_stats)
+    record['batches'] += id_stats['batches']
 
-enr_res_up.loc[enr_res_up['Adjusted P-value'] < .05]
+  # Optional: cache hit rate and mapping latency against a local stub biomart server
+  # bench_id_mapping(n_ids=5000)
 
-dotplot(enr_up.res2d, title='UP Genes - GO_Biological_Process_2021',cmap='viridis_r', size=10, figsize=(3,5))
+  """Also run the following cell to briefly inspect the API returns of Entrez gene names for corresponding gene ids for the first 5 of them, and the total length of the corresponding lists."""
 
-# Down-regulated genes, cis vs untrt
-enr_down = gp.enrichr(gene_list=gene_names_down,
-                 gene_sets=['GO_Biological_Process_2021'],
-                 organism='mouse',
-                 outdir=None,
-                )
-enr_res_down = enr_down.results
+  print(gene_names_up[:5], len(set(gene_names_up)), gene_names_down[:5], len(set(gene_names_down)))
 
-enr_res_down.loc[enr_res_down['Adjusted P-value'] < .05]
+  """**Task10**: Run the following cell. You will see all of the Mouse gene set libraries that are present within EnrichR. You will see a lot of GO and KEGG database names with different years of version. What is [GO](http://geneontology.org/) database? GO is spllited into 3 major ontologies; Molecular Function, Cellular Component, Biological Process, what are they and how are they different? What is [KEGG](https://www.genome.jp/kegg/pathway.html) pathway database?"""
 
-dotplot(enr_down.res2d, title='DOWN Genes - GO_Biological_Process_2021',cmap='viridis_r', size=10, figsize=(3,5))
+  # Check out libraries that are present for Mouse
+  print(gp.get_library_name(organism='Mouse'))
 
-"""**Task11:** You have printed the dataframes of signigicant pathways that are enriched in down- and up-regulated genes, seperately. You have also drawn the dotplots of the major pathways associated with them, coming from the respective dataframes.
+  """<< The GO database has annotated genes (with 'GO terms') that represent the products and the function of the gene. The factors used to make the GO terms are Molecular Function, Cellular Component, Biological Process. Molecular function refers to the role of the gene in the cell. The activities performed by the gene products are represented by this. The cellular component is the location of the gene - this can be (1) the "cellular anatomical entities" which includes the cellular structures where the function of the gene products is carried out, and (2) the macromolecular complexes the gene products are a part of. Lastly, the Biological Process refers to the big processes the gene products are a part of, where multiple molecular activities work together to finish the process (it is to be noted that this isn't a pathway, but rather the process the gene products are a part of). The KEGG pathway database is a collection of pathways, each of which are represented by a 2-4 letter prefix code and 5-digit number.>>
 
-Inspect the both results while considering biological relevance to cisplatin treatment. What do you think cisplatin caused?
+  Run the following 4 cells, where we are going to use library of **GO_Biological_Process_2021** with our **Over-representation analysis.**
+  """
 
-<<Most of the upregulated genes seem to be related to misfolded proteins and apoptosis/cell death. The "regulation of cellular response to stress" get upregulated, which is a kind of defense mechanism that occurs when the protein folding ability of the endoplasmic reticulum (ER) is disturbed somehow, in order to restore the function of the ER. Moreover, mutations in the E3 ubiquitin ligase are what cause the ER stress to occur, which is supported by there being an upregulation of the genes related to "regulation of cellular response to stress" as well as the "regulation of protein ubiquitination", which involves enzymes, including E3s according to a paper titled "Ubiquitination in the regulation of inflammatory cell death and cancer" (Cockram et al., 2021). ER stress can also be caused when there are too many newly synthesized proteins that need to be folded (Haeri and Knox, 2021), which is also supported by the fact there is an increase in the genes responsible for the "negative regulation of transcription by RNA polymerase II". Overall, this shows that cisplatin may be causing mutations in the part of the DNA encoding the E3 ubiquitin ligase enzyme, which results in ER stress, which then leads to apoptosis/cell death. Most of the downregulated genes are related to transcription, signal transduction and migration. The downregulation of the filopodium assembly genes shows that the filopodium which is responsible for migration has been stopped from being assembled - this is something that cancer cells in malignant tumors do which is what makes the cancer so dangerous, hence it is possible that the cisplatin is responsible for this, or perhaps this is just related to the apoptotic genes being upregulated, which then causes these genes to be downregulated so that the cell can be killed. The upregulation of the apoptotic genes may be the reason why the genes responsible for the positive developmental process got downregulated. The downregulation of the genes responsible for the transcription initiation from RNA polymerase II. RNA polymerase II is responsible for transcribing DNA to RNA, which is halted, possibly because cell death is about to occur.
+  # Load the library once and score both gene lists locally in one pass
+  # (offline when GO_Biological_Process_2021.gmt has been downloaded next to this notebook)
+  with stage('enrichment', gene_lists=2, genes=len(gene_names_up) + len(gene_names_down)):
+    go_bp_index = load_library('GO_Biological_Process_2021', organism='Mouse')
+    enr = enrichr_local({'up': gene_names_up, 'down': gene_names_down}, go_bp_index)
 
-Overall, the big picture may be that the ER-stress induced apoptosis is occurring in the cells treated with cisplatin. >>
+  # Up-regulated genes, cis vs untrt
+  enr_up = enr['up']
+  enr_res_up = enr_up.results
+
+  print(enr_res_up.loc[enr_res_up['Adjusted P-value'] < .05])
+
+  # the dotplots are saved next to stages.csv, as a script has no cell output to draw them in
+  dotplot(enr_up.res2d, title='UP Genes - GO_Biological_Process_2021',cmap='viridis_r', size=10, figsize=(3,5), ofname='dotplot_up.png')
+
+  # Down-regulated genes, cis vs untrt
+  enr_down = enr['down']
+  enr_res_down = enr_down.results
+
+  print(enr_res_down.loc[enr_res_down['Adjusted P-value'] < .05])
+
+  dotplot(enr_down.res2d, title='DOWN Genes - GO_Biological_Process_2021',cmap='viridis_r', size=10, figsize=(3,5), ofname='dotplot_down.png')
+
+  # Sweep padj/LFC cutoffs: the index is built once, and ID mapping and enrichment run once per distinct gene set
+  stats_index = build_stats_index(stat_res.results_df)
+  sweep, sweep_memo = sweep_degs({'kidney': stats_index}, padj_thrs=[0.01, 0.05, 0.1], lfc_thrs=[0.5, 1, 2],
+                                 gene_set_index=go_bp_index)
+  print(sweep.pivot_table(index=['padj_thr', 'lfc_thr'], columns='direction', values=['degs', 'enriched_terms']))
+
+  """**Task11:** You have printed the dataframes of signigicant pathways that are enriched in down- and up-regulated genes, seperately. You have also drawn the dotplots of the major pathways associated with them, coming from the respective dataframes.
+
+  Inspect the both results while considering biological relevance to cisplatin treatment. What do you think cisplatin caused?
+
+  <<Most of the upregulated genes seem to be related to misfolded proteins and apoptosis/cell death. The "regulation of cellular response to stress" get upregulated, which is a kind of defense mechanism that occurs when the protein folding ability of the endoplasmic reticulum (ER) is disturbed somehow, in order to restore the function of the ER. Moreover, mutations in the E3 ubiquitin ligase are what cause the ER stress to occur, which is supported by there being an upregulation of the genes related to "regulation of cellular response to stress" as well as the "regulation of protein ubiquitination", which involves enzymes, including E3s according to a paper titled "Ubiquitination in the regulation of inflammatory cell death and cancer" (Cockram et al., 2021). ER stress can also be caused when there are too many newly synthesized proteins that need to be folded (Haeri and Knox, 2021), which is also supported by the fact there is an increase in the genes responsible for the "negative regulation of transcription by RNA polymerase II". Overall, this shows that cisplatin may be causing mutations in the part of the DNA encoding the E3 ubiquitin ligase enzyme, which results in ER stress, which then leads to apoptosis/cell death. Most of the downregulated genes are related to transcription, signal transduction and migration. The downregulation of the filopodium assembly genes shows that the filopodium which is responsible for migration has been stopped from being assembled - this is something that cancer cells in malignant tumors do which is what makes the cancer so dangerous, hence it is possible that the cisplatin is responsible for this, or perhaps this is just related to the apoptotic genes being upregulated, which then causes these genes to be downregulated so that the cell can be killed. The upregulation of the apoptotic genes may be the reason why the genes responsible for the positive developmental process got downregulated. The downregulation of the genes responsible for the transcription initiation from RNA polymerase II. RNA polymerase II is responsible for transcribing DNA to RNA, which is halted, possibly because cell death is about to occur.
+
+  Overall, the big picture may be that the ER-stress induced apoptosis is occurring in the cells treated with cisplatin. >>
+  """
+
+  """To run Tasks 2-11 for every organ as a scheduled job instead of stepping through the cells, use run_pipeline(). It writes report.html, report.json, the result tables and the figure files into out_dir without calling fig.show().
+  """
+
+  # report = run_pipeline('counts.tsv', 'clinical.tsv', out_dir='report', max_workers=4)
+  # (or from a shell: python geneExpression.py report counts.tsv clinical.tsv --out-dir report)
+
+  # Benchmarks on synthetic data at 1x, 10x and 100x the cohort size; compare a later run against this baseline with
+  # compare_benchmarks('bench_baseline.json', 'bench_results.json')
+  # run_benchmarks(scales=(1, 10, 100), out_path='bench_baseline.json')
+
+  """Time, CPU, peak memory and input sizes of every stage that ran in this notebook (also saved as stages.csv):"""
+
+  write_stage_log(STAGE_LOG, 'stages.csv')
+  return pd.DataFrame(STAGE_LOG)
+
+"""geneExpression.py can also be run from the command line, one stage per subcommand, e.g.:
+
+    python geneExpression.py load counts.tsv clinical.tsv
+    python geneExpression.py dge counts.tsv clinical.tsv --out results.tsv --degs-dir degs
+    python geneExpression.py pca counts.tsv clinical.tsv --out pca.tsv --html pca.html
+    python geneExpression.py map-ids degs/kidney_up.txt --out kidney_up_names.txt
+    python geneExpression.py enrich kidney_up_names.txt --library GO_Biological_Process_2021 --out enrichment.tsv
+    python geneExpression.py report counts.tsv clinical.tsv --out-dir report
+    python geneExpression.py bench --scales 1 10 --out bench_results.json
+    python geneExpression.py notebook counts.tsv clinical.tsv
+
+Importing the module only imports pandas and numpy; each subcommand imports the libraries of its own stage. --stage-log writes the stage() records of the run to a JSON or CSV file.
 """
+
+def _read_lines(path):
+  f = sys.stdin if path == '-' else open(path)
+  with f:
+    return [line.strip() for line in f if line.strip()]
+
+def _write_lines(lines, path):
+  f = sys.stdout if path == '-' else open(path, 'w')
+  with f:
+    f.writelines(f'{line}\n' for line in lines)
+
+def _read_clinical(path):
+  return pd.read_csv(path, sep='\t').set_index('sampleID').sort_index(ascending=True)
+
+def _cli_load(args):
+  clinical_df = _read_clinical(args.clinical)
+  with stage('load') as record:
+    if args.sparse:
+      counts = load_counts_sparse(args.counts, clinical_df, min_count=args.min_count)
+      record['samples'], record['genes'] = counts.matrix.shape
+    else:
+      counts = load_counts_cached(args.counts, clinical_df, clinical_path=args.clinical, min_count=args.min_count,
+                                  cache_dir=args.cache_dir)
+      record['samples'], record['genes'] = counts.shape
+  if args.out:
+    counts = densify_counts(counts) if args.sparse else counts
+    counts.T.to_csv(args.out, sep='\t')
+
+def _cli_dge(args):
+  clinical_df = _read_clinical(args.clinical)
+  counts_df = load_counts_cached(args.counts, clinical_df, clinical_path=args.clinical, min_count=args.min_count)
+  with stage('contrasts', samples=counts_df.shape[0], genes=counts_df.shape[1],
+             groups=clinical_df[args.group_col].nunique()):
+    all_res_df = run_contrasts(counts_df, clinical_df, study=args.study, group_col=args.group_col, factor=args.factor,
+                               tested=args.tested, ref=args.ref, max_workers=args.max_workers)
+  all_res_df.to_csv(args.out, sep='\t', index=False)
+
+  if args.degs_dir:
+    os.makedirs(args.degs_dir, exist_ok=True)
+    gene_col = counts_df.columns.name or 'geneIDs'
+    for group, res_df in all_res_df.groupby(args.group_col, sort=True):
+      up_degs_df, down_degs_df = query_degs(build_stats_index(res_df.set_index(gene_col), lfc_thrs=()),
+                                            padj_thr=args.padj, lfc_thr=args.lfc)
+      _write_lines(up_degs_df.index, os.path.join(args.degs_dir, f'{group}_up.txt'))
+      _write_lines(down_degs_df.index, os.path.join(args.degs_dir, f'{group}_down.txt'))
+      print(f'{group}: {len(up_degs_df)} up, {len(down_degs_df)} down')
+
+def _cli_pca(args):
+  from pydeseq2.dds import DeseqDataSet
+  clinical_df = _read_clinical(args.clinical)
+  counts_df = load_counts_cached(args.counts, clinical_df, clinical_path=args.clinical, min_count=args.min_count)
+  dds = DeseqDataSet(counts=counts_df, metadata=clinical_df, design_factors=args.factor, quiet=True)
+  with stage('vst', samples=dds.n_obs, genes=dds.n_vars):
+    cached_vst(dds)
+  with stage('pca', samples=dds.n_obs, genes=min(args.ntop, dds.n_vars) if args.ntop else dds.n_vars):
+    result = pca_stage(dds, nTop=args.ntop, solver=args.solver)
+  pca_df = pd.DataFrame(result.pca_data, index=dds.obs_names, columns=list(result.loadings.columns))
+  pca_df.join(clinical_df).to_csv(args.out, sep='\t')
+  print('Explained variance ratio: ' + ', '.join(f'{v:.3f}' for v in result.pca.explained_variance_ratio_))
+  if args.html:
+    with collect_figures() as figures:
+      plotPCA(dds, clinical_df, nTop=args.ntop, solver=args.solver)
+    figures[0][1].write_html(args.html)
+
+def _cli_map_ids(args):
+  if args.import_table:
+    import_id_table(args.import_table, cache_path=args.cache, dataset=args.dataset)
+  ids = [i for path in args.ids for i in _read_lines(path)]
+  # the mapping report goes to stderr, so the names can be piped from stdout
+  with redirect_stdout(sys.stderr), stage('map_ids', degs=len(ids)) as record:
+    id_stats = {}
+    mapping = map_ids(ids, cache_path=args.cache, dataset=args.dataset, batch_size=args.batch_size,
+                      max_workers=args.max_workers, offline=args.offline, stats=id_stats)
+    record['batches'] = id_stats['batches']
+  if args.table:
+    _write_lines((f'{i}\t{name or ""}' for i, name in mapping.items()), args.out)
+  else:
+    _write_lines((name.upper() for name in mapping.values() if name), args.out)
+
+def _cli_enrich(args):
+  gene_lists = {os.path.splitext(os.path.basename(path))[0] if path != '-' else 'genes': _read_lines(path)
+                for path in args.gene_lists}
+  with stage('enrichment', gene_lists=len(gene_lists), genes=sum(map(len, gene_lists.values()))):
+    enr = enrichr_local(gene_lists, load_library(args.library, organism=args.organism, gmt_path=args.gmt))
+  enr_df = pd.concat({name: e.results for name, e in enr.items()}, names=['gene_list']).reset_index(0)
+  enr_df.to_csv(args.out, sep='\t', index=False)
+  for name, e in enr.items():
+    print(f"{name}: {int((e.results['Adjusted P-value'] < args.padj).sum())} terms with adjusted p < {args.padj}")
+
+def _cli_report(args):
+  report = run_pipeline(args.counts, args.clinical, out_dir=args.out_dir, study=args.study, min_count=args.min_count,
+                        group_col=args.group_col, factor=args.factor, tested=args.tested, ref=args.ref,
+                        padj_thr=args.padj, lfc_thr=args.lfc, nTop=args.ntop, library=args.library,
+                        organism=args.organism, max_workers=args.max_workers, image_format=args.image_format,
+                        profile_stage=args.profile_stage, profiler=args.profiler)
+  STAGE_LOG.extend(report['stages'])
+  print(f"Wrote {os.path.join(args.out_dir, 'report.html')}")
+
+def _cli_bench(args):
+  results = run_benchmarks(scales=args.scales, n_genes=args.genes, replicates=args.replicates, repeat=args.repeat,
+                           data_dir=args.data_dir, out_path=args.out, n_cpus=args.n_cpus, seed=args.seed)
+  print(results.pivot_table(index='stage', columns='scale', values='wall_seconds', sort=False).to_string())
+  if args.compare:
+    print(compare_benchmarks(args.compare, args.out).to_string())
+
+def _cli_notebook(args):
+  run_notebook(args.counts, args.clinical)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='geneExpression.py', description='GSE117167 differential expression analysis')
+  parser.add_argument('--stage-log', help='write the stage measurements of this run to a .json or .csv file')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  def command(name, func, help, inputs=True):
+    sub = commands.add_parser(name, help=help)
+    sub.set_defaults(func=func)
+    if inputs:
+      sub.add_argument('counts', nargs='?', default='counts.tsv')
+      sub.add_argument('clinical', nargs='?', default='clinical.tsv')
+      sub.add_argument('--min-count', type=int, default=10)
+    return sub
+
+  def contrast_args(sub):
+    sub.add_argument('--study', default='GSE117167')
+    sub.add_argument('--group-col', default='organ')
+    sub.add_argument('--factor', default='condition')
+    sub.add_argument('--tested', default='cis')
+    sub.add_argument('--ref', default='untrt')
+    sub.add_argument('--padj', type=float, default=0.05)
+    sub.add_argument('--lfc', type=float, default=1)
+    sub.add_argument('--max-workers', type=int)
+
+  sub = command('load', _cli_load, 'load and filter the counts, filling the counts cache')
+  sub.add_argument('--sparse', action='store_true', help='keep the counts as a sparse matrix')
+  sub.add_argument('--cache-dir', default='counts_cache')
+  sub.add_argument('--out', help='write the filtered counts as a TSV')
+
+  sub = command('dge', _cli_dge, 'run the treated vs reference contrast for every group')
+  contrast_args(sub)
+  sub.add_argument('--out', default='results.tsv')
+  sub.add_argument('--degs-dir', help='write <group>_up.txt / <group>_down.txt gene id lists here')
+
+  sub = command('pca', _cli_pca, 'VST and PCA of all samples')
+  sub.add_argument('--factor', default='condition')
+  sub.add_argument('--ntop', type=int, default=500)
+  sub.add_argument('--solver', default='full', choices=['full', 'randomized', 'incremental'])
+  sub.add_argument('--out', default='pca.tsv')
+  sub.add_argument('--html', help='also write the 3D PCA plot')
+
+  sub = command('map-ids', _cli_map_ids, 'map Ensembl gene ids to Entrez gene names', inputs=False)
+  sub.add_argument('ids', nargs='+', help="files with one gene id per line, or '-' for stdin")
+  sub.add_argument('--out', default='-')
+  sub.add_argument('--table', action='store_true', help='write id<TAB>name rows instead of the mapped names')
+  sub.add_argument('--cache', default='id_cache.sqlite')
+  sub.add_argument('--dataset', default=BIOMART_DATASET)
+  sub.add_argument('--import-table', help='fill the cache from a biomart TSV export first')
+  sub.add_argument('--batch-size', type=int, default=200)
+  sub.add_argument('--max-workers', type=int, default=4)
+  sub.add_argument('--offline', action='store_true')
+
+  sub = command('enrich', _cli_enrich, 'over-representation analysis of gene name lists', inputs=False)
+  sub.add_argument('gene_lists', nargs='+', help="files with one gene name per line, or '-' for stdin")
+  sub.add_argument('--library', default='GO_Biological_Process_2021')
+  sub.add_argument('--organism', default='Mouse')
+  sub.add_argument('--gmt', help='gene set library file (default: <library>.gmt if present, else download)')
+  sub.add_argument('--padj', type=float, default=0.05)
+  sub.add_argument('--out', default='enrichment.tsv')
+
+  sub = command('report', _cli_report, 'run every stage for every group and write an HTML report')
+  contrast_args(sub)
+  sub.add_argument('--out-dir', default='report')
+  sub.add_argument('--ntop', type=int, default=500)
+  sub.add_argument('--library', default='GO_Biological_Process_2021')
+  sub.add_argument('--organism', default='Mouse')
+  sub.add_argument('--image-format', default='png')
+  sub.add_argument('--profile-stage')
+  sub.add_argument('--profiler', default='cprofile', choices=['cprofile', 'pyinstrument'])
+
+  sub = command('bench', _cli_bench, 'benchmark the stages on synthetic data', inputs=False)
+  sub.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100])
+  sub.add_argument('--genes', type=int, default=30000)
+  sub.add_argument('--replicates', type=int, default=2)
+  sub.add_argument('--repeat', type=int, default=1)
+  sub.add_argument('--data-dir', default='bench_data')
+  sub.add_argument('--n-cpus', type=int)
+  sub.add_argument('--seed', type=int, default=0)
+  sub.add_argument('--out', default='bench_results.json')
+  sub.add_argument('--compare', help='baseline results to compare the new run against')
+
+  command('notebook', _cli_notebook, 'run the Task 1-11 walkthrough')
+
+  args = parser.parse_args(argv)
+  args.func(args)
+  if args.stage_log:
+    write_stage_log(STAGE_LOG, args.stage_log)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def clinical_df():
+  return pd.DataFrame({'organ': ['kidney', 'kidney'], 'condition': ['cis', 'untrt']},
+                      index=pd.Index(['A', 'B'], name='sampleID'))
+
+
+@pytest.fixture
+def write_counts(tmp_path):
+  def write(text, name='counts.tsv'):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+  return write
@@ -0,0 +1,67 @@
+import json
+
+import pandas as pd
+import pytest
+
+import geneExpression as ge
+
+
+def test_simulated_counts_load_like_the_real_files(tmp_path):
+  counts_path, clinical_path = str(tmp_path / 'counts.tsv'), str(tmp_path / 'clinical.tsv')
+  truth = ge.simulate_counts(counts_path, clinical_path, n_genes=200, replicates=2, chunksize=64, seed=1)
+
+  with open(counts_path) as f:
+    header = f.readline().rstrip('\n').split('\t')
+  clinical_df = pd.read_csv(clinical_path, sep='\t').set_index('sampleID').sort_index(ascending=True)
+  assert header == ['geneIDs', *clinical_df.index]
+  assert list(clinical_df.columns) == ['organ', 'condition']
+  assert clinical_df.groupby(['organ', 'condition']).size().eq(2).all()
+  assert len(clinical_df) == 12
+
+  counts_df = ge.load_counts(counts_path, clinical_df, min_count=0, verbose=False)
+  assert counts_df.shape == (12, 200)
+  assert list(counts_df.columns) == list(truth.index)
+  assert (counts_df.index.name, counts_df.columns.name) == ('sampleID', 'geneIDs')
+  raw = pd.read_csv(counts_path, sep='\t', index_col='geneIDs')
+  pd.testing.assert_frame_equal(counts_df, raw.T.loc[clinical_df.index], check_dtype=False, check_names=False)
+
+
+def test_simulated_gene_sets():
+  genes = [f'g{i}' for i in range(50)]
+  gene_sets = ge.simulate_gene_sets(genes, n_terms=20, min_size=5, max_size=10)
+  assert len(gene_sets) == 20
+  for members in gene_sets.values():
+    assert 5 <= len(members) <= 10
+    assert len(set(members)) == len(members)
+    assert set(members) <= {g.upper() for g in genes}
+
+
+def write_results(path, seconds):
+  records = [{'scale': 1, 'run': run, 'stage': stage, 'wall_seconds': s}
+             for stage, runs in seconds.items() for run, s in enumerate(runs)]
+  with open(path, 'w') as f:
+    json.dump({'meta': {}, 'results': records}, f)
+  return str(path)
+
+
+def test_compare_benchmarks_flags_regressions(tmp_path):
+  baseline = write_results(tmp_path / 'baseline.json', {'load': [1.0, 1.2, 9.0], 'dge': [2.0]})
+  current = write_results(tmp_path / 'current.json', {'load': [1.3], 'dge': [3.0]})
+  comparison = ge.compare_benchmarks(baseline, current, threshold=1.2)
+  # the baseline median over repeats ignores the 9 s outlier
+  assert comparison.loc[(1, 'load'), 'baseline'] == pytest.approx(1.2)
+  assert comparison.loc[(1, 'load'), 'ratio'] == pytest.approx(1.3 / 1.2)
+  assert comparison['regression'].to_dict() == {(1, 'load'): False, (1, 'dge'): True}
+
+
+def test_run_benchmarks_writes_comparable_results(tmp_path):
+  pytest.importorskip('pydeseq2')
+  out_path = str(tmp_path / 'bench.json')
+  records = ge.run_benchmarks(scales=(1,), n_genes=300, n_terms=20, data_dir=str(tmp_path / 'data'), out_path=out_path)
+  assert list(records['stage']) == ['load_filter', 'deseq2', 'vst', 'pca_prep', 'wald_test', 'deg_filter', 'enrichment']
+
+  with open(out_path) as f:
+    results = json.load(f)
+  assert set(results['meta']['params']) == {'scales', 'n_genes', 'replicates', 'repeat', 'data_dir', 'out_path',
+                                            'min_count', 'padj_thr', 'lfc_thr', 'nTop', 'n_terms', 'n_cpus', 'seed'}
+  assert not ge.compare_benchmarks(out_path, out_path)['regression'].any()
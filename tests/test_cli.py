@@ -0,0 +1,69 @@
+import json
+
+import pandas as pd
+import pytest
+
+import geneExpression as ge
+
+
+@pytest.fixture(autouse=True)
+def clean_stage_log(monkeypatch):
+  monkeypatch.setattr(ge, 'STAGE_LOG', [])
+
+
+@pytest.fixture
+def id_table(tmp_path):
+  path = tmp_path / 'mart_export.tsv'
+  path.write_text('Gene stable ID\tNCBI gene (formerly Entrezgene) accession\n'
+                  'ENSMUSG01\tTrp53\nENSMUSG02\t\nENSMUSG03\tCdkn1a\n')
+  return str(path)
+
+
+def test_map_ids_offline(tmp_path, id_table, capsys):
+  ids = tmp_path / 'kidney_up.txt'
+  ids.write_text('ENSMUSG03\nENSMUSG02\nENSMUSG01\nENSMUSG09\n')
+  out, cache = tmp_path / 'names.txt', str(tmp_path / 'id_cache.sqlite')
+  stage_log = tmp_path / 'stages.json'
+
+  ge.main(['--stage-log', str(stage_log), 'map-ids', str(ids), '--offline', '--import-table', id_table,
+           '--cache', cache, '--out', str(out)])
+  assert out.read_text() == 'CDKN1A\nTRP53\n'
+  # the mapping report goes to stderr only
+  captured = capsys.readouterr()
+  assert captured.out == '' and 'cache hit rate 75.0%' in captured.err
+  with open(stage_log) as f:
+    assert [(r['stage'], r['degs'], r['batches']) for r in json.load(f)] == [('map_ids', 4, 0)]
+
+  # the cache filled by --import-table is reused, and --table keeps the unmapped ids
+  ge.main(['map-ids', str(ids), '--offline', '--cache', cache, '--table', '--out', str(out)])
+  assert out.read_text() == 'ENSMUSG03\tCdkn1a\nENSMUSG02\t\nENSMUSG01\tTrp53\nENSMUSG09\t\n'
+
+
+def test_enrich_with_gmt(tmp_path, capsys):
+  gmt = tmp_path / 'lib.gmt'
+  gmt.write_text('apoptosis\t\tTRP53\tCDKN1A\tBAX\n'
+                 'migration\t\tACTB,1.0\tVIM,1.0\n')
+  up, down = tmp_path / 'up.txt', tmp_path / 'down.txt'
+  up.write_text('Trp53\nCdkn1a\n')
+  down.write_text('Vim\n')
+  out = tmp_path / 'enrichment.tsv'
+
+  ge.main(['enrich', str(up), str(down), '--library', 'lib', '--gmt', str(gmt), '--padj', '1.01', '--out', str(out)])
+  enr_df = pd.read_csv(out, sep='\t')
+  assert list(enr_df.columns) == ['gene_list', *ge.ENRICHR_COLUMNS]
+  assert enr_df[['gene_list', 'Term', 'Overlap', 'Genes']].values.tolist() == [
+      ['up', 'apoptosis', '2/3', 'CDKN1A;TRP53'], ['down', 'migration', '1/2', 'VIM']]
+  assert capsys.readouterr().out.splitlines() == ['up: 1 terms with adjusted p < 1.01',
+                                                  'down: 1 terms with adjusted p < 1.01']
+
+
+def test_load_writes_filtered_counts(tmp_path, write_counts):
+  counts = write_counts('geneIDs\tA\tB\ng1\t11\t1\ng2\t1\t1\ng3\t0\t30\n')
+  clinical = tmp_path / 'clinical.tsv'
+  clinical.write_text('sampleID\torgan\tcondition\nB\tkidney\tuntrt\nA\tkidney\tcis\n')
+  for args in ([], ['--sparse']):
+    out = tmp_path / f'filtered{len(args)}.tsv'
+    ge.main(['load', counts, str(clinical), '--cache-dir', str(tmp_path / 'cache'), '--out', str(out), *args])
+    filtered = pd.read_csv(out, sep='\t', index_col=0)
+    assert list(filtered.index) == ['g1', 'g3'] and list(filtered.columns) == ['A', 'B']
+    assert filtered.loc['g3', 'B'] == 30
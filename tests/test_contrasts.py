@@ -0,0 +1,50 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import geneExpression as ge
+
+
+@pytest.fixture
+def cached_counts(tmp_path):
+  clinical_df = pd.DataFrame({'organ': ['kidney'] * 4, 'condition': ['cis', 'cis', 'untrt', 'untrt']},
+                             index=pd.Index(list('ABCD'), name='sampleID'))
+  path = tmp_path / 'counts.tsv'
+  path.write_text('geneIDs\tA\tB\tC\tD\n' + ''.join(f'g{i}\t{i + 10}\t{i + 12}\t{i + 20}\t{i + 21}\n' for i in range(5)))
+  cache_dir = str(tmp_path / 'cache')
+  ge.load_counts_cached(str(path), clinical_df, cache_dir=cache_dir, verbose=False)
+  return ge.load_counts_cached(str(path), clinical_df, cache_dir=cache_dir, verbose=False)
+
+
+def test_shared_counts_uses_matching_cache_file(cached_counts):
+  npy_path, key = ge._shared_counts(cached_counts)
+  assert npy_path == ge._memmap_path(cached_counts)
+  assert key == cached_counts.attrs['cache_key']
+
+
+def test_shared_counts_rejects_replaced_file(cached_counts, tmp_path):
+  npy_path = ge._memmap_path(cached_counts)
+  # another dataset's matrix moved onto the path counts_df was mapped from
+  other = str(tmp_path / 'other.npy')
+  np.save(other, np.zeros((4, 3), dtype=np.uint32))
+  os.replace(other, npy_path)
+  assert ge._shared_counts(cached_counts) is None
+
+
+def test_shared_counts_rejects_other_manifest_key(cached_counts):
+  npy_path = ge._memmap_path(cached_counts)
+  with open(os.path.splitext(npy_path)[0] + '.manifest.json', 'w') as f:
+    json.dump({'key': 'other'}, f)
+  assert ge._shared_counts(cached_counts) is None
+
+
+def test_worker_refuses_mismatched_file(cached_counts):
+  npy_path, key = ge._shared_counts(cached_counts)
+  samples = cached_counts.index
+  metadata = pd.DataFrame({'condition': ['cis', 'cis', 'untrt', 'untrt']}, index=samples)
+  with pytest.raises(ValueError, match='no longer holds'):
+    ge._deseq_contrast(npy_path, (key, (4, 99), 'uint32'), np.arange(4), cached_counts.columns,
+                       metadata, 'condition', 'cis', 'untrt', 1)
@@ -0,0 +1,44 @@
+import os
+
+import geneExpression as ge
+
+
+def test_same_file_name_in_two_studies(clinical_df, tmp_path, capsys):
+  paths = {}
+  for study, count in [('a', 11), ('b', 22)]:
+    os.makedirs(tmp_path / study)
+    paths[study] = str(tmp_path / study / 'counts.tsv')
+    with open(paths[study], 'w') as f:
+      f.write(f'geneIDs\tA\tB\ng1\t{count}\t1\n')
+
+  cache_dir = str(tmp_path / 'cache')
+  for study in ['a', 'b', 'a', 'b']:
+    counts_df = ge.load_counts_cached(paths[study], clinical_df, cache_dir=cache_dir)
+    assert counts_df.iloc[0, 0] == (11 if study == 'a' else 22)
+
+  out = capsys.readouterr().out
+  assert 'Rebuilding' not in out
+  assert out.count('Memory-mapped') == 2
+  assert len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]) == 2
+
+
+def test_cache_reports_key(clinical_df, write_counts, tmp_path):
+  path = write_counts('geneIDs\tA\tB\ng1\t11\t1\n')
+  cache_dir = str(tmp_path / 'cache')
+  built = ge.load_counts_cached(path, clinical_df, cache_dir=cache_dir, verbose=False)
+  mapped = ge.load_counts_cached(path, clinical_df, cache_dir=cache_dir, verbose=False)
+  assert built.attrs['cache_key'] == mapped.attrs['cache_key']
+  assert ge._manifest_key(ge._memmap_path(mapped)) == mapped.attrs['cache_key']
+
+
+def test_rewritten_source_replaces_its_cache(clinical_df, write_counts, tmp_path, capsys):
+  cache_dir = str(tmp_path / 'cache')
+  for count in (11, 22, 33):
+    path = write_counts(f'geneIDs\tA\tB\ng1\t{count}\t1\n')
+    assert ge.load_counts_cached(path, clinical_df, cache_dir=cache_dir).iloc[0, 0] == count
+    assert ge.load_counts_cached(path, clinical_df, cache_dir=cache_dir).iloc[0, 0] == count
+
+  out = capsys.readouterr().out
+  assert out.count('Rebuilding counts cache') == 2
+  assert out.count('Memory-mapped') == 3
+  assert sorted(f.split('.', 1)[1] for f in os.listdir(cache_dir)) == ['manifest.json', 'npy']
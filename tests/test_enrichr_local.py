@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+import geneExpression as ge
+
+
+@pytest.fixture
+def index():
+  return ge.load_gene_sets({'lib': {
+      'alpha': ['A', 'B', 'C'],
+      'beta': ['C', 'D', 'E', 'F'],
+      'gamma': ['G', 'H'],
+  }})
+
+
+def test_hypergeom_sf_matches_scipy():
+  rng = np.random.default_rng(0)
+  N = 2000
+  K = rng.integers(1, 400, 500)
+  n = rng.integers(1, 400, 500)
+  lo, hi = np.maximum(0, K + n - N), np.minimum(K, n)
+  k = lo + (rng.random(500) * (hi - lo + 1)).astype(int)
+  np.testing.assert_allclose(ge._hypergeom_sf(k, N, K, n), stats.hypergeom.sf(k - 1, N, K, n), rtol=1e-6, atol=1e-300)
+
+
+def test_empty_gene_lists(index):
+  assert ge.enrichr_local({}, index) == {}
+
+
+def test_fully_covered_term_has_finite_scores(index):
+  res = ge.enrichr_local({'up': ['a', 'b', 'c']}, index)['up'].res2d
+  alpha = res.set_index('Term').loc['alpha']
+  assert alpha['Overlap'] == '3/3'
+  assert np.isfinite(res[['Odds Ratio', 'Combined Score']].to_numpy()).all()
+  # Haldane-corrected 2x2 table: 3 in list and term, 0 in list only, 0 in term only, 5 in neither
+  assert alpha['Odds Ratio'] == pytest.approx(3.5 * 5.5 / (0.5 * 0.5))
+
+
+def test_background_list_restricts_terms_and_lists(index):
+  background = ['a', 'B', 'C', 'D', 'X', 'Y']
+  res = ge.enrichr_local({'up': ['A', 'C', 'E', 'G']}, index, background=background)['up'].res2d.set_index('Term')
+  # E and G are outside the background: beta is scored as C, D and gamma drops out
+  assert res['Overlap'].to_dict() == {'alpha': '2/3', 'beta': '1/2'}
+  assert res.loc['alpha', 'P-value'] == pytest.approx(stats.hypergeom.sf(1, 6, 3, 2))
+  assert res.loc['beta', 'P-value'] == pytest.approx(stats.hypergeom.sf(0, 6, 2, 2))
+  assert res.loc['beta', 'Genes'] == 'C'
+
+
+def test_background_count_and_bad_type(index):
+  res = ge.enrichr_local({'up': ['A', 'B']}, index, background=100)['up'].res2d
+  assert res.loc[0, 'P-value'] == pytest.approx(stats.hypergeom.sf(1, 100, 3, 2))
+  with pytest.raises(TypeError):
+    ge.enrichr_local({'up': ['A']}, index, background='A')
+  # smaller than the 8 library genes: the hypergeometric terms would be undefined
+  with pytest.raises(ValueError, match='background'):
+    ge.enrichr_local({'up': list('ABCDEF')}, index, background=5)
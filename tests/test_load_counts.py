@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+import geneExpression as ge
+
+
+def test_filters_low_counts_into_uint32(clinical_df, write_counts):
+  path = write_counts('geneIDs\tA\tB\ng1\t5\t6\ng2\t1\t2\ng3\t7\t8\n')
+  counts_df = ge.load_counts(path, clinical_df, verbose=False)
+  assert list(counts_df.columns) == ['g1', 'g3']
+  assert counts_df.to_numpy().tolist() == [[5, 7], [6, 8]]
+  assert counts_df.to_numpy().dtype == np.uint32
+
+
+def test_file_without_trailing_newline(clinical_df, write_counts):
+  path = write_counts('geneIDs\tA\tB\ng1\t5\t6\ng2\t7\t8')
+  counts_df = ge.load_counts(path, clinical_df, verbose=False)
+  assert counts_df.to_numpy().tolist() == [[5, 7], [6, 8]]
+
+
+@pytest.mark.parametrize('loader', [ge.load_counts, ge.load_counts_sparse])
+def test_negative_counts_raise(clinical_df, write_counts, loader):
+  path = write_counts('geneIDs\tA\tB\ng1\t5\t6\ng2\t-5\t80\n')
+  with pytest.raises(ValueError, match='Negative counts'):
+    loader(path, clinical_df, verbose=False)
+
+
+def test_counts_above_uint32_are_kept(clinical_df, write_counts):
+  path = write_counts('geneIDs\tA\tB\ng1\t5\t6\ng2\t5000000000\t8\ng3\t9\t9\n')
+  counts_df = ge.load_counts(path, clinical_df, chunksize=1, verbose=False)
+  assert counts_df.to_numpy().dtype == np.uint64
+  assert counts_df.to_numpy().tolist() == [[5, 5000000000, 9], [6, 8, 9]]
+
+
+def test_missing_samples_raise(clinical_df, write_counts):
+  path = write_counts('geneIDs\tA\tC\ng1\t5\t6\n')
+  with pytest.raises(KeyError, match='Samples missing'):
+    ge.load_counts(path, clinical_df, verbose=False)
@@ -0,0 +1,109 @@
+import sqlite3
+import urllib.error
+
+import pytest
+
+import geneExpression as ge
+
+
+@pytest.fixture
+def stub():
+  servers = []
+  def start(**kwargs):
+    server = ge._stub_biomart(latency=0, **kwargs)
+    servers.append(server)
+    return server
+  yield start
+  for server in servers:
+    server.shutdown()
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+  return str(tmp_path / 'id_cache.sqlite')
+
+
+def ids(n, start=0):
+  return [f'ENSMUSG{i:011d}' for i in range(start, start + n)]
+
+
+def test_cold_then_warm(stub, cache_path):
+  server = stub()
+  cold_stats, warm_stats = {}, {}
+  cold = ge.map_ids(ids(50), cache_path=cache_path, url=server.url, batch_size=20, verbose=False, stats=cold_stats)
+  warm = ge.map_ids(ids(50), cache_path=cache_path, url=server.url, batch_size=20, verbose=False, stats=warm_stats)
+
+  assert cold == warm
+  assert (cold_stats['cache_hits'], cold_stats['fetched'], cold_stats['batches']) == (0, 50, 3)
+  assert (warm_stats['cache_hits'], warm_stats['fetched'], warm_stats['batches']) == (50, 0, 0)
+  assert sum(map(len, server.requests)) == 50
+
+
+def test_only_misses_are_fetched(stub, cache_path):
+  server = stub()
+  ge.map_ids(ids(30), cache_path=cache_path, url=server.url, verbose=False)
+  server.requests.clear()
+  stats = {}
+  ge.map_ids(ids(40, start=20), cache_path=cache_path, url=server.url, verbose=False, stats=stats)
+  assert (stats['cache_hits'], stats['fetched']) == (10, 30)
+  assert sorted(i for batch in server.requests for i in batch) == ids(30, start=30)
+
+
+def test_ids_without_accession_are_cached_as_null(stub, cache_path):
+  server = stub()
+  mapping = ge.map_ids(ids(20), cache_path=cache_path, url=server.url, verbose=False)
+  # the stub leaves every tenth id of a request without an accession
+  assert [i for i, name in mapping.items() if name is None] == [ids(20)[0], ids(20)[10]]
+  with sqlite3.connect(cache_path) as con:
+    nulls = con.execute('SELECT COUNT(*) FROM id_map WHERE entrezgene_accession IS NULL').fetchone()[0]
+  assert nulls == 2
+
+  server.requests.clear()
+  again = ge.map_ids(ids(20), cache_path=cache_path, url=server.url, verbose=False)
+  assert again == mapping
+  assert server.requests == []
+
+
+def test_result_follows_input_order_and_duplicates(stub, cache_path):
+  server = stub()
+  query = [ids(5)[3], ids(5)[1], ids(5)[3], ids(5)[4]]
+  mapping = ge.map_ids(query, cache_path=cache_path, url=server.url, batch_size=2, max_workers=2, verbose=False)
+  assert list(mapping) == [ids(5)[3], ids(5)[1], ids(5)[4]]
+  # batches are [3, 1] and [4]; the stub leaves the first id of each batch unnamed
+  assert [mapping[i] for i in query] == [None, 'Gene000001', None, None]
+  assert sorted(map(sorted, server.requests)) == [[ids(5)[1], ids(5)[3]], [ids(5)[4]]]
+
+
+def test_retries_then_succeeds(stub, cache_path):
+  server = stub(failures=2)
+  mapping = ge.map_ids(ids(5, start=1), cache_path=cache_path, url=server.url, retries=2, backoff=0, verbose=False)
+  assert len(server.requests) == 3
+  assert list(mapping.values()) == [None, 'Gene000002', 'Gene000003', 'Gene000004', 'Gene000005']
+
+
+def test_retries_then_raises(stub, cache_path):
+  server = stub(failures=10)
+  with pytest.raises(urllib.error.HTTPError):
+    ge.map_ids(ids(5), cache_path=cache_path, url=server.url, retries=2, backoff=0, verbose=False)
+  assert len(server.requests) == 3
+  with sqlite3.connect(cache_path) as con:
+    assert con.execute('SELECT COUNT(*) FROM id_map').fetchone()[0] == 0
+
+
+def test_offline_uses_cache_only(stub, cache_path, tmp_path):
+  table = tmp_path / 'ids.tsv'
+  table.write_text('Gene stable ID\tNCBI gene (formerly Entrezgene) accession\n'
+                   f'{ids(2)[0]}\tGene0\n{ids(2)[1]}\t\n')
+  assert ge.import_id_table(str(table), cache_path=cache_path) == 2
+  stats = {}
+  mapping = ge.map_ids(ids(3), cache_path=cache_path, offline=True, verbose=False, stats=stats)
+  assert mapping == {ids(3)[0]: 'Gene0', ids(3)[1]: None, ids(3)[2]: None}
+  assert (stats['cache_hits'], stats['fetched']) == (2, 0)
+
+
+def test_bench_id_mapping_reports_each_run():
+  report = ge.bench_id_mapping(n_ids=100, latency=0, max_workers=2)
+  assert list(report['run']) == ['cold', 'mixed', 'warm']
+  assert list(report['hit_rate']) == [0, 0.5, 1]
+  assert list(report['fetched']) == [50, 50, 0]
+  assert (report['seconds'] >= 0).all()
@@ -0,0 +1,90 @@
+import anndata as ad
+import numpy as np
+import pandas as pd
+import pytest
+
+import geneExpression as ge
+
+
+@pytest.fixture
+def dds():
+  counts = np.arange(12, dtype=float).reshape(3, 4)
+  adata = ad.AnnData(X=counts)
+  adata.layers['normed_counts'] = counts.copy()
+  return adata
+
+
+def test_mean_normed_counts_is_cached(dds):
+  first = ge.mean_normed_counts(dds)
+  np.testing.assert_array_equal(first, [4, 5, 6, 7])
+  assert ge.mean_normed_counts(dds) is first
+
+
+def test_mean_normed_counts_follows_replaced_layer(dds):
+  ge.mean_normed_counts(dds)
+  dds.layers['normed_counts'] = np.ones((3, 4))
+  np.testing.assert_array_equal(ge.mean_normed_counts(dds), [1, 1, 1, 1])
+
+
+@pytest.fixture
+def vst_dds():
+  rng = np.random.default_rng(0)
+  adata = ad.AnnData(X=rng.poisson(20, size=(12, 30)).astype(float))
+  adata.layers['vst_counts'] = np.log1p(adata.X)
+  return adata
+
+
+def test_pca_stage_reuses_the_fit(vst_dds):
+  first = ge.pca_stage(vst_dds, nTop=10)
+  assert ge.pca_stage(vst_dds, nTop=10) is first
+  assert ge.pca_stage(vst_dds, nTop=20) is not first
+
+
+def test_pca_stage_keys_on_batch_size(vst_dds):
+  small = ge.pca_stage(vst_dds, solver='incremental', batch_size=4)
+  large = ge.pca_stage(vst_dds, solver='incremental', batch_size=12)
+  assert small is not large
+  assert ge.pca_stage(vst_dds, solver='incremental', batch_size=4) is small
+
+
+def test_pca_stage_refits_a_changed_layer():
+  rng = np.random.default_rng(1)
+  dds = ad.AnnData(X=rng.poisson(20, size=(50, 2000)).astype(float))
+  dds.layers['vst_counts'] = np.log1p(dds.X)
+  first = ge.pca_stage(dds, nTop=500)
+  # a single column, far fewer cells than a sampled digest would look at
+  dds.layers['vst_counts'][:, 7] = np.linspace(0, 100, 50)
+  second = ge.pca_stage(dds, nTop=500)
+  assert second is not first
+  assert 7 in second.idx and 7 not in first.idx
+
+
+def test_pca_stage_attaches_loadings(vst_dds):
+  result = ge.pca_stage(vst_dds, nTop=10)
+  assert result.pca.loadings_ is result.loadings
+  assert list(result.loadings.columns) == ['pc1', 'pc2', 'pc3']
+  assert len(result.loadings) == 10
+
+
+def test_pca_stage_rejects_small_batches(vst_dds):
+  with pytest.raises(ValueError, match='batch_size'):
+    ge.pca_stage(vst_dds, solver='incremental', batch_size=2)
+
+
+def test_dispersion_plot_data_from_dds_and_res_df(dds):
+  for key, value in zip(ge.DISPERSION_KEYS, (1.0, 2.0, 4.0)):
+    dds.varm[key] = np.full(4, value)
+  res_df = pd.DataFrame({'baseMean': [4.0, 5, 6, 7], **{key: dds.varm[key] for key in ge.DISPERSION_KEYS}})
+
+  from_dds = ge.dispersion_plot_data(dds)
+  pd.testing.assert_frame_equal(ge.dispersion_plot_data(res_df=res_df), from_dds)
+  assert from_dds['name'].value_counts().to_dict() == dict.fromkeys(ge.DISPERSION_NAMES, 4)
+  with pytest.raises(TypeError):
+    ge.dispersion_plot_data()
+  with pytest.raises(TypeError):
+    ge.dispersion_plot_data(dds, res_df=res_df)
+
+
+def test_pca_stage_ntop_above_gene_count(vst_dds):
+  result = ge.pca_stage(vst_dds, nTop=500)
+  assert len(result.loadings) == vst_dds.n_vars
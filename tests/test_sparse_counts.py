@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pydeseq2.preprocessing import deseq2_norm
+
+import geneExpression as ge
+
+
+COUNTS = ('geneIDs\tA\tB\n'
+          'g1\t10\t20\n'
+          'g2\t0\t30\n'
+          'g3\t1\t2\n'
+          'g4\t5\t7\n')
+
+
+@pytest.fixture
+def sparse_counts(clinical_df, write_counts):
+  return ge.load_counts_sparse(write_counts(COUNTS), clinical_df, min_count=10, verbose=False)
+
+
+def test_sparse_matches_dense(clinical_df, write_counts, sparse_counts):
+  dense_df = ge.load_counts(write_counts(COUNTS, 'dense.tsv'), clinical_df, min_count=10, verbose=False)
+  assert list(sparse_counts.genes) == ['g1', 'g2', 'g4']
+  pd.testing.assert_frame_equal(ge.densify_counts(sparse_counts), dense_df, check_dtype=False, check_names=False)
+
+  normed, factors = deseq2_norm(dense_df.to_numpy())
+  np.testing.assert_allclose(ge.sparse_size_factors(sparse_counts), factors)
+  np.testing.assert_allclose(ge.sparse_normed_counts(sparse_counts).toarray(), normed)
+
+
+def test_size_factors_need_a_gene_without_zeros(clinical_df, write_counts):
+  counts = ge.load_counts_sparse(write_counts('geneIDs\tA\tB\ng1\t0\t20\ng2\t30\t0\n'),
+                                 clinical_df, min_count=10, verbose=False)
+  with pytest.raises(ValueError):
+    ge.sparse_size_factors(counts)
@@ -0,0 +1,93 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import geneExpression as ge
+
+
+def allocate_mb(mb):
+  # touch every page so the allocation shows up in the RSS
+  block = np.ones(mb * 2**20 // 8)
+  return float(block.sum())
+
+
+def test_records_sizes_and_timings():
+  log = []
+  with ge.stage('load', log=log, samples=4) as record:
+    record['genes'] = 10
+  assert len(log) == 1 and log[0] is record
+  assert record['stage'] == 'load'
+  assert (record['samples'], record['genes']) == (4, 10)
+  for key in ['wall_seconds', 'cpu_seconds', 'children_cpu_seconds', 'peak_rss_mb', 'children_peak_rss_mb_lifetime']:
+    assert record[key] >= 0
+
+
+def test_record_is_logged_when_the_stage_fails():
+  log = []
+  with pytest.raises(RuntimeError):
+    with ge.stage('broken', log=log):
+      raise RuntimeError
+  assert [r['stage'] for r in log] == ['broken']
+  assert log[0]['wall_seconds'] is not None
+
+
+def test_nested_stages_keep_the_inner_peak():
+  if not ge._reset_peak_rss():
+    pytest.skip('no per-stage peak RSS on this platform')
+  log = []
+  with ge.stage('outer', log=log):
+    with ge.stage('inner', log=log):
+      allocate_mb(200)
+    with ge.stage('after', log=log):
+      pass
+  inner, after, outer = log
+  assert [r['stage'] for r in log] == ['inner', 'after', 'outer']
+  # the 200 MB were freed before 'after' started, and its reset high-water mark does not see them
+  assert inner['peak_rss_mb'] > after['peak_rss_mb'] + 150
+  # while the enclosing stage still reports them although 'after' reset the mark
+  assert outer['peak_rss_mb'] >= inner['peak_rss_mb']
+  assert ge._open_stages == []
+
+
+def test_lifetime_peak_without_clear_refs(monkeypatch):
+  monkeypatch.setattr(ge, '_reset_peak_rss', lambda: False)
+  log = []
+  with ge.stage('fallback', log=log):
+    pass
+  assert log[0]['peak_rss_mb'] == pytest.approx(ge._peak_rss_mb(), rel=0.05)
+
+
+def test_instrumented_uses_the_function_name(monkeypatch):
+  log = []
+  monkeypatch.setattr(ge, 'STAGE_LOG', log)
+
+  @ge.instrumented(genes=3)
+  def filter_genes():
+    return 'done'
+
+  assert filter_genes() == 'done'
+  assert [(r['stage'], r['genes']) for r in log] == [('filter_genes', 3)]
+
+
+@pytest.mark.parametrize('suffix', ['json', 'csv'])
+def test_write_stage_log_round_trip(tmp_path, suffix):
+  log = []
+  with ge.stage('load', log=log, samples=4):
+    pass
+  with ge.stage('dge', log=log, degs=7):
+    pass
+  path = ge.write_stage_log(log, str(tmp_path / f'stages.{suffix}'))
+
+  if suffix == 'json':
+    with open(path) as f:
+      loaded = pd.DataFrame(json.load(f))
+  else:
+    loaded = pd.read_csv(path)
+  expected = pd.DataFrame(log)
+  assert list(loaded.columns) == list(expected.columns)
+  assert list(loaded['stage']) == ['load', 'dge']
+  assert loaded['samples'].iloc[0] == 4 and pd.isna(loaded['samples'].iloc[1])
+  assert loaded['degs'].iloc[1] == 7 and pd.isna(loaded['degs'].iloc[0])
+  np.testing.assert_allclose(loaded['wall_seconds'], expected['wall_seconds'])
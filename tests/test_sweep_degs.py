@@ -0,0 +1,52 @@
+import pandas as pd
+import pytest
+
+import geneExpression as ge
+
+
+@pytest.fixture
+def stats_index():
+  res_df = pd.DataFrame({'log2FoldChange': [2.0, 1.5, -2.0, 0.1],
+                         'padj': [0.001, 0.01, 0.001, 0.5]},
+                        index=['ENSG1', 'ENSG2', 'ENSG3', 'ENSG4'])
+  return {'kidney': ge.build_stats_index(res_df)}
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+  cache_path = str(tmp_path / 'id_cache.sqlite')
+  for dataset, prefix in (('mouse', 'M'), ('human', 'H')):
+    table = tmp_path / f'{dataset}.tsv'
+    table.write_text('Gene stable ID\tNCBI gene (formerly Entrezgene) accession\n'
+                     + ''.join(f'ENSG{i}\t{prefix}{i}\n' for i in range(1, 5)))
+    ge.import_id_table(str(table), cache_path=cache_path, dataset=dataset)
+  return cache_path
+
+
+def sweep(stats_index, library, memo, **map_kwargs):
+  # with a four-gene background nothing is significant, so any overlapping term counts
+  return ge.sweep_degs(stats_index, padj_thrs=[0.05], lfc_thrs=[1], gene_set_index=library, memo=memo,
+                       term_padj_thr=0.5, offline=True, verbose=False, **map_kwargs)
+
+
+def test_memo_is_keyed_by_library(stats_index, cache_path):
+  mouse_up = ge.load_gene_sets({'lib': {'up': ['M1', 'M2'], 'other': ['M3', 'M4']}})
+  no_match = ge.load_gene_sets({'lib': {'up': ['X1', 'X2'], 'other': ['M3', 'M4']}})
+  first, memo = sweep(stats_index, mouse_up, None, cache_path=cache_path, dataset='mouse')
+  second, memo = sweep(stats_index, no_match, memo, cache_path=cache_path, dataset='mouse')
+  third, memo = sweep(stats_index, mouse_up, memo, cache_path=cache_path, dataset='mouse')
+
+  enriched = lambda df: df.set_index('direction')['enriched_terms'].to_dict()
+  assert enriched(first) == {'up': 1, 'down': 1}
+  assert enriched(second) == {'up': 0, 'down': 1}
+  assert second.attrs == {'new_id_sets': 0, 'new_gene_lists': 2}
+  assert third.attrs == {'new_id_sets': 0, 'new_gene_lists': 0}
+  assert enriched(third) == enriched(first)
+
+
+def test_memo_is_keyed_by_dataset(stats_index, cache_path):
+  library = ge.load_gene_sets({'lib': {'mouse': ['M1', 'M2'], 'human': ['H1', 'H2']}})
+  mouse, memo = sweep(stats_index, library, None, cache_path=cache_path, dataset='mouse')
+  human, memo = sweep(stats_index, library, memo, cache_path=cache_path, dataset='human')
+  assert human.attrs == {'new_id_sets': 2, 'new_gene_lists': 2}
+  assert mouse.loc[mouse['direction'] == 'up', 'gene_set'].item() != human.loc[human['direction'] == 'up', 'gene_set'].item()